@@ -1,11 +1,8 @@
-import os
 import random
 from collections import Counter
-
-import pandas as pd
 from pathlib import Path
 
-from utils import rows_to_dataset, validate_dataset
+from utils import rows_to_dataset, validate_dataset, export_dataset, hash_inputs, needs_build, load_source, source_version
 
 
 # adapted from sentence_grammar_acceptability.py
@@ -79,11 +76,25 @@ def _shuffle_label_order(df):
     df.loc[indices, "inversed_order"] = True
 
 
-if __name__ == "__main__":
-    # full path: zrc/datasets/sLM21/lexical/dev
-    root_path = Path("lexical/dev").absolute()
-    gold_path = root_path / "gold.csv"
-    df = pd.read_csv(gold_path)
+# full path: zrc/datasets/sLM21/lexical/dev
+SOURCE = {"csv": "lexical/dev/gold.csv"}
+REPO_ID = "DynamicSuperb/NonceWordDetection_sWUGGY"
+
+
+def inputs_hashes():
+    return {REPO_ID: hash_inputs(source_version(SOURCE), Path(__file__))}
+
+
+def build(df=None):
+    root_path = Path(SOURCE["csv"]).parent.absolute()
+    repo_id = REPO_ID
+    inputs_hash = inputs_hashes()[repo_id]
+    if not needs_build(repo_id, inputs_hash):
+        print(f"{repo_id} is up to date")
+        return
+
+    if df is None:
+        df = load_source(SOURCE)
 
     df = _sample_df(df)
     print("length distribution", Counter(df.length))
@@ -120,4 +131,8 @@ if __name__ == "__main__":
 
     ds = rows_to_dataset(rows)
     validate_dataset(ds)
-    ds.push_to_hub(repo_id="DynamicSuperb/NonceWordDetection_sWUGGY", split="test", token=os.environ["HF_TOKEN"])
+    export_dataset(ds, repo_id=repo_id, split="test", inputs_hash=inputs_hash)
+
+
+if __name__ == "__main__":
+    build()
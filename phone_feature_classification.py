@@ -1,16 +1,19 @@
+import io
+import math
 import random
 import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
+import numpy as np
 import pandas as pd
-from datasets import load_dataset, Dataset, Audio
-from panphon import FeatureTable
-import panphon.sonority
-from panphon.distance import Distance
+from datasets import Dataset
 from ipapy import UNICODE_TO_IPA
 from ipapy.ipachar import IPAVowel, IPAConsonant
 import soundfile as sf
 
-from utils import validate_dataset
+from utils import audio_durations, cast_audio, panphon_distance, panphon_feature_table, panphon_sonority, validate_dataset, export_dataset, hash_inputs, needs_build, load_source, source_version
 
 # TODO: pick limited phone set and only pick these phones (with 1 diacritic?)
 # TODO: could also narrow the set down when we generate the answer - include the 5 closest phones using FED?
@@ -209,8 +212,11 @@ manner_classification_instructions = [
 manner_classification_instructions = [inst + MANNER_SET_STR + "." for inst in manner_classification_instructions]
 
 # place of articulation
-PLACE_SET = list(set([p.place for p in UNICODE_TO_IPA.values() if isinstance(p, IPAConsonant)]))
-PLACE_SET_STR = ", ".join(PLACE_SET[:-1]) + ", or " + PLACE_SET[-1]
+# PLACE_SET scans every ipapy character, so it is only built on first use
+@lru_cache(maxsize=None)
+def place_set():
+    return sorted(set(p.place for p in UNICODE_TO_IPA.values() if isinstance(p, IPAConsonant)))
+
 place_classification_instructions = [
     "The audio clip consists of three phones. What is the manner of articulation of the phone in the middle? The answer could be: ",
     "The audio clip consists of three phones. Identify the manner of articulation of the phone in the middle. The answer could be: ",
@@ -276,7 +282,11 @@ place_classification_instructions = [
     "Based on this audio clip that consists of 3 phones, please name the manner of articulation of the phone in the middle. The phone is one of the following: ",
     "Based on this audio clip that consists of 3 phones, please determine the manner of articulation of the phone in the middle. The phone is one of the following: "
 ]
-place_classification_instructions = [inst + PLACE_SET_STR + "." for inst in place_classification_instructions]
+
+@lru_cache(maxsize=None)
+def place_instructions():
+    place_set_str = ", ".join(place_set()[:-1]) + ", or " + place_set()[-1]
+    return [inst + place_set_str + "." for inst in place_classification_instructions]
 
 
 HEIGHT_SET = ["close", "mid", "open"]  # IPA https://www.internationalphoneticassociation.org/sites/default/files/IPA_Kiel_2015.pdf
@@ -576,23 +586,53 @@ def manner_of_articulation(phone, ft):
     print("could not determine manner of articulation for ", phone)
     return ""
 
+@lru_cache(maxsize=None)
+def _reference_phones(ft, dist):
+    # the phones of UNICODE_TO_IPA recognized by panphon (in key order), as zero-padded feature vectors
+    phones = [phone for phone in UNICODE_TO_IPA.keys() if ft.ipa_segs(phone)]
+    vectors = [dist.fm.word_to_vector_list(phone, numeric=True) for phone in phones]
+    lengths = np.array([len(v) for v in vectors])
+    padded = np.zeros((len(phones), lengths.max(), len(dist.fm.names)))
+    for i, v in enumerate(vectors):
+        padded[i, :len(v)] = v
+    return phones, padded, lengths
+
+@lru_cache(maxsize=None)
+def _closest_reference_phone(consonant, ft, dist):
+    # dist.feature_edit_distance(consonant, phone) against every reference phone at once
+    #   panphon's costs are sums of 0.5 and 1 over the features, so the numbers are exactly the same
+    phones, targets, lengths = _reference_phones(ft, dist)
+    num_features = targets.shape[2]
+    source = np.array(dist.fm.word_to_vector_list(consonant, numeric=True)).reshape(-1, num_features)
+    deletion = np.where(source == 0, 0.5, 1).sum(axis=-1) / num_features
+    insertion = np.where(targets == 0, 0.5, 1).sum(axis=-1) / num_features
+    substitution = (np.abs(source[None, :, None] - targets[:, None]) / 2).sum(axis=-1) / num_features
+
+    d = np.zeros((len(phones), len(source) + 1, targets.shape[1] + 1))
+    for i in range(1, len(source) + 1):
+        d[:, i, 0] = d[:, i - 1, 0] + deletion[i - 1]
+    for j in range(1, targets.shape[1] + 1):
+        d[:, 0, j] = d[:, 0, j - 1] + insertion[:, j - 1]
+    for i in range(1, len(source) + 1):
+        for j in range(1, targets.shape[1] + 1):
+            d[:, i, j] = np.minimum(np.minimum(
+                d[:, i - 1, j] + deletion[i - 1],
+                d[:, i - 1, j - 1] + substitution[:, i - 1, j - 1]),
+                d[:, i, j - 1] + insertion[:, j - 1])
+    fed = d[np.arange(len(phones)), len(source), lengths]
+
+    # the first phone with the smallest distance, as long as it is below 1
+    closest = np.argmin(fed)
+    return phones[closest] if fed[closest] < 1.0 else ''
+
+@lru_cache(maxsize=None)
 def place_of_articulation(consonant, ft, dist):
     if consonant in UNICODE_TO_IPA:
         return UNICODE_TO_IPA[consonant].place
 
     # find the closest phone in UNICODE_TO_IPA then get its place
-    min_fed = 1.0
-    closest_phone = ''
-    for phone in UNICODE_TO_IPA.keys():
-        # not recognized by panphon
-        if not ft.ipa_segs(phone):
-            continue
-
-        fed = dist.feature_edit_distance(consonant, phone)
-        if fed < min_fed:
-            min_fed = fed
-            closest_phone = phone
-    if isinstance(UNICODE_TO_IPA[closest_phone], IPAConsonant):
+    closest_phone = _closest_reference_phone(consonant, ft, dist)
+    if closest_phone and isinstance(UNICODE_TO_IPA[closest_phone], IPAConsonant):
         print('mapped', consonant, 'to', closest_phone)
         return UNICODE_TO_IPA[closest_phone].place
     return ""
@@ -647,18 +687,206 @@ def vowel_roundedness(vowel, ft):
         return "unrounded"
 
 
-if __name__ == "__main__":
-    ds = load_dataset(
-        "kalbin/VoxAngeles_phones",
-        cache_dir="datasets_cache",
-        revision="refs/convert/parquet",
-    )
-    ds = ds["test"]
+# phones with at least this sonority are vowels
+VOWEL_SONORITY = 8
+
+def phone_feature_table(phones, ft, dist, son):
+    """
+    Features and labels of every phone, as arrays indexed by phone id (the position in phones)
+    Each classifier runs once per distinct phone instead of once per row
+    """
+    table = {
+        "vector": np.zeros((len(phones), len(ft.names))),
+        "sonority": np.full(len(phones), np.nan),
+    }
+    for name in ("manner", "place", "height", "frontness", "roundedness"):
+        table[name] = np.full(len(phones), "", dtype=object)
+
+    for i, phone in enumerate(phones):
+        # ft.ipa_segs to convert to normalized decomposed form
+        segs = ft.ipa_segs(phone)
+        if not segs:
+            continue
+        if ft.fts(phone):
+            table["vector"][i] = ft.fts(phone).numeric()
+        table["sonority"][i] = son.sonority(segs[-1])
+        table["manner"][i] = manner_of_articulation(phone, ft)
+        if table["sonority"][i] >= VOWEL_SONORITY:
+            table["height"][i] = vowel_height(phone, ft)
+            table["frontness"][i] = vowel_frontness(phone, ft)
+            table["roundedness"][i] = vowel_roundedness(phone, ft)
+        else:
+            table["place"][i] = place_of_articulation(phone, ft, dist)
+    return table
+
+def select_triphones(df, ft, son):
+    """
+    Pick 3 consecutive phone entries of every word in each language, as one row with start_t, finish_t and phones
+    Same rows and random draws as filtering and applying over groupby(['lang', 'word']), one draw per word
+    """
+    # rows of each (lang, word), groups in sorted order and rows in their original order
+    #   rows with a null lang or word are in no group (NaN or -1 depending on the pandas version), drop them like groupby does
+    group_ids = df.groupby(['lang', 'word']).ngroup().to_numpy(dtype=np.float64)
+    grouped = np.flatnonzero(~np.isnan(group_ids) & (group_ids >= 0))
+    group_ids = group_ids[grouped].astype(np.int64)
+    order = grouped[np.argsort(group_ids, kind='stable')]
+    sizes = np.bincount(group_ids)
+    offsets = np.cumsum(sizes) - sizes
+
+    # ensure there are at least 3 phones in the word
+    # skip duplicate words in the language
+    #   if a language has 2+ instances of the same word
+    #   then the number of entries in the group will be a multiple of the # phones in the word
+    words = df['word'].to_numpy()[order[offsets]]
+    num_segs = {word: len(ft.ipa_segs(word)) for word in set(words[sizes >= 3])}
+    kept = np.flatnonzero([size >= 3 and num_segs[word] == size for word, size in zip(words, sizes)])
+
+    # for each word in the lang, pick 3 consecutive phone entries
+    start_pos = np.array([random.randint(0, size - 3) for size in sizes[kept]], dtype=np.int64)
+    rows = order[(offsets[kept] + start_pos)[:, None] + np.arange(3)]
+
+    # exclude diphthongs for now (the formant transitions may reveal anyway)
+    phones = df['phone'].to_numpy()[rows]
+    vowel, known = {}, {}
+    for phone in set(phones.flat):
+        try:
+            # ft.ipa_segs to convert to normalized decomposed form
+            vowel[phone], known[phone] = son.sonority(ft.ipa_segs(phone)[-1]) >= VOWEL_SONORITY, True
+        except:
+            # panphon cannot handle the phone, discard its triphones for now
+            vowel[phone], known[phone] = False, False
+    is_vowel, is_known = np.vectorize(vowel.get, otypes=[bool])(phones), np.vectorize(known.get, otypes=[bool])(phones)
+    (x, mid, y), (x_known, mid_known, y_known) = is_vowel.T, is_known.T
+    # y is only looked at when mid is a vowel and x is not
+    unknown = ~x_known | ~mid_known | (mid & ~x & ~y_known)
+    for triphone in phones[unknown]:
+        print(*triphone)
+    keep = ~unknown & ~(mid & (x | y))
+
+    # extract timestamps for the triphone environment
+        # reduce each triphone into its first row
+    rows, phones = rows[keep], phones[keep]
+    triphone_df = df.iloc[rows[:, 0]].reset_index(drop=True)
+    triphone_df['start_t'] = df['start'].to_numpy()[rows[:, 0]]
+    triphone_df['finish_t'] = df['finish'].to_numpy()[rows[:, 2]]
+    triphone_df['phones'] = phones[:, 0] + " " + phones[:, 1] + " " + phones[:, 2]
+    return triphone_df.drop(['start', 'finish', 'phone'], axis=1)
+
+@lru_cache(maxsize=None)
+def _resample_filter(orig_sr, target_sr):
+    # the same low-pass FIR filter scipy.signal.resample_poly designs, built once per rate pair
+    from scipy.signal import firwin
+    g = math.gcd(orig_sr, target_sr)
+    up, down = target_sr // g, orig_sr // g
+    max_rate = max(up, down)
+    return up, down, firwin(2 * 10 * max_rate + 1, 1. / max_rate, window=('kaiser', 5.0))
+
+def _read_spans(path, spans, sampling_rate):
+    # open the recording once and read only the frames of each (start_t, finish_t) span
+    segments = []
+    with sf.SoundFile(path) as f:
+        for start_t, finish_t in spans:
+            start, end = int(start_t * f.samplerate), int(finish_t * f.samplerate)
+            f.seek(start)
+            segment = f.read(end - start)
+            assert len(segment) > 0, (path, start, end)
+            if segment.ndim > 1:
+                # downmix like datasets' Audio(mono=True)
+                segment = segment.mean(axis=1)
+            if f.samplerate != sampling_rate:
+                from scipy.signal import resample_poly
+                up, down, window = _resample_filter(f.samplerate, sampling_rate)
+                segment = resample_poly(segment, up, down, window=window)
+            segments.append((start, end, segment))
+    return segments
+
+def _segment_language(root, lang, recordings, sampling_rate, in_memory):
+    # every triphone of one language: recordings is a list of (file, positions, spans)
+    results = []
+    for file, positions, spans in recordings:
+        segments = _read_spans(f"{root}/{lang}/{file}.wav", spans, sampling_rate)
+        for position, (start, end, segment) in zip(positions, segments):
+            name = f"{file}_{start}_{end}.wav"
+            if in_memory:
+                buffer = io.BytesIO()
+                sf.write(buffer, segment, samplerate=sampling_rate, subtype="PCM_16", format="WAV")
+                results.append((position, {"bytes": buffer.getvalue(), "path": name}, name))
+            else:
+                path = f"{root}/{lang}/{name}"
+                sf.write(path, segment, samplerate=sampling_rate, subtype="PCM_16")
+                results.append((position, path, name))
+    return results
+
+def segment_audio(df, root, sampling_rate=16_000, in_memory=True, num_workers=8):
+    """
+    Cut the triphone (start_t to finish_t) of every row out of its word recording, resampled to 16-bit sampling_rate
+    Rows are grouped by recording, so each file is opened once and only the needed frames are decoded;
+    languages are spread over worker processes
+    Segments are returned as in-memory WAV audio dicts, or written next to the recordings if in_memory is False
+    """
+    recordings_by_lang = defaultdict(list)
+    for (lang, file), positions in df.groupby(['lang', 'file'], sort=False).indices.items():
+        rows = df.iloc[positions]
+        recordings_by_lang[lang].append((file, positions, list(zip(rows['start_t'], rows['finish_t']))))
+
+    audio, names = [None] * len(df), [None] * len(df)
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(_segment_language, root, lang, recordings, sampling_rate, in_memory)
+            for lang, recordings in recordings_by_lang.items()
+        ]
+        for future in futures:
+            for position, segment, name in future.result():
+                audio[position], names[position] = segment, name
+    return audio, names
+
+
+# bump whenever the shared word subsetting, triphone selection or segmentation changes,
+# every variant is rebuilt then; label functions and instructions are tracked per variant
+PIPELINE_VERSION = 3
+
+# worker processes for segmenting and resampling the triphones, one language at a time
+NUM_WORKERS = 8
+
+SOURCE = {"path": "kalbin/VoxAngeles_phones", "revision": "refs/convert/parquet", "split": "test", "cache_dir": "datasets_cache"}
+
+
+def _repo_id(task_name):
+    return f"DynamicSuperb/PhonologicalFeatureClassification_VoxAngeles-{task_name}"
+
+
+def inputs_hashes():
+    # inputs of each variant, so that only the variants whose inputs changed are rebuilt
+        # phone_feature_table decides which rows are vowels and which get a place label, so every variant depends on it
+    source = source_version(SOURCE)
+    shared = (source, PIPELINE_VERSION, phone_feature_table, VOWEL_SONORITY)
+    return {
+        _repo_id("Phone"): hash_inputs(*shared, phone_classification_instructions),
+        _repo_id("MannerOfArticulation"): hash_inputs(*shared, manner_classification_instructions, manner_of_articulation),
+        _repo_id("ConsonantPlaceOfArticulation"): hash_inputs(*shared, place_instructions(), place_of_articulation, _closest_reference_phone, _reference_phones),
+        _repo_id("VowelFrontness"): hash_inputs(*shared, frontness_classification_instructions, vowel_frontness),
+        _repo_id("VowelHeight"): hash_inputs(*shared, height_classification_instructions, vowel_height),
+        _repo_id("VowelRoundedness"): hash_inputs(*shared, roundedness_classification_instructions, vowel_roundedness),
+    }
+
+
+def build(ds=None):
+    hashes = inputs_hashes()
+    stale_tasks = {
+        task_name for task_name in ("Phone", "MannerOfArticulation", "ConsonantPlaceOfArticulation", "VowelFrontness", "VowelHeight", "VowelRoundedness")
+        if needs_build(_repo_id(task_name), hashes[_repo_id(task_name)])
+    }
+    if not stale_tasks:
+        print("PhonologicalFeatureClassification tasks are up to date")
+        return
+
+    if ds is None:
+        ds = load_source(SOURCE)
     df = pd.DataFrame(ds)
 
     random.seed(15213)
 
-    son, ft, dist = panphon.sonority.Sonority(), FeatureTable(), Distance()
+    son, ft, dist = panphon_sonority(), panphon_feature_table(), panphon_distance()
 
     # pick subset of each language's words (1000 / 95)
     WORD_LIMIT = 1000  # approx 1 hour
@@ -673,139 +901,84 @@ if __name__ == "__main__":
             .reset_index(drop=True)
 
     # select triphone environment from the phonetic transcription of the word
-
-    # ensure there are at least 3 phones in the word
-    df = df.groupby(['lang', 'word']) \
-            .filter(lambda group: len(group) >= 3) \
-            .reset_index(drop=True)
-    # skip duplicate words in the language
-    #   if a language has 2+ instances of the same word
-    #   then the number of entries in the groupby will be a multiple of the # phones in the word
-    def no_duplicate(word_df):
-        (_, word) = word_df.name
-        return len(ft.ipa_segs(word)) == len(word_df)
-    df = df.groupby(['lang', 'word']) \
-            .filter(no_duplicate) \
-            .reset_index(drop=True)
-    def get_triphone(word_df):
-        # for each word in the lang, pick 3 consecutive phone entries
-        start_pos = random.randint(0, len(word_df) - 3)
-        return word_df.iloc[start_pos:start_pos + 3]
-    df = df.groupby(['lang', 'word']) \
-            .apply(get_triphone) \
-            .reset_index(drop=True)
-
-    # exclude diphthongs for now (the formant transitions may reveal anyway)
-    VOWEL_SONORITY = 8
-    def is_vowel(phone):
-        # ft.ipa_segs to convert to normalized decomposed form
-        return son.sonority(ft.ipa_segs(phone)[-1]) >= VOWEL_SONORITY
-    def no_diphthong(triphone_df):
-        assert len(triphone_df) == 3
-        # ensure index starts at 0
-        triphone_df = triphone_df.reset_index(drop=True)
-        x, mid, y = triphone_df.loc[0, 'phone'], triphone_df.loc[1, 'phone'], triphone_df.loc[2, 'phone']
-        try:
-            return not ((is_vowel(x) and is_vowel(mid)) or (is_vowel(mid) and is_vowel(y)))
-        except:
-            print(x, mid, y)
-            # panphon cannot handle one of the phones, discard for now
-            # j a ʡ
-            # m æ ʜ
-            # ʡ y r
-            # ʡ æ ɡʷ
-            # ʡ æ ʃ
-            # h ӕː t
-            # i g i
-            return False
-    df = df.groupby(['lang', 'word']) \
-            .filter(no_diphthong) \
-            .reset_index(drop=True)
-
-    # extract timestamps for the triphone environment
-        # reduce each group into one
-    def extract_timestamps(word_df):
-        assert len(word_df) == 3
-        word_df = word_df.reset_index(drop=True)
-
-        word_df['start_t'] = word_df.loc[0, 'start']
-        word_df['finish_t'] = word_df.loc[2, 'finish']
-        word_df['phones'] = word_df.loc[0, 'phone'] + " " + word_df.loc[1, 'phone'] + " " + word_df.loc[2, 'phone']
-        return word_df.iloc[0]
-    df = df.groupby(['lang', 'word']) \
-        .apply(extract_timestamps) \
-        .reset_index(drop=True)
-    df = df.drop(['start', 'finish', 'phone'], axis=1)
+    df = select_triphones(df, ft, son)
 
     # Filter out samples longer than 2 seconds
     df = df[(df['finish_t'] - df['start_t']) <= 2]
 
     # load the audio
         # extract the timestamp from the audio
-        # save as new file
+        # keep the 16 kHz segments in memory, no files are written into the corpus
     VOXANGELES_PATH = 'data/voxangeles/data/audited_aligned'
     if not os.path.exists(VOXANGELES_PATH):
         raise Exception("Please download VoxAngeles at data/")
-    def segment_audio(row):
-        full_word_path = f"{VOXANGELES_PATH}/{row['lang']}/{row['file']}.wav"
-        # 44100 Hz
-        audio, sampling_rate = sf.read(full_word_path)
-        start, end = int(row['start_t'] * sampling_rate), int(row['finish_t'] * sampling_rate)
-        segmented_path = f"{VOXANGELES_PATH}/{row['lang']}/{row['file']}_{start}_{end}.wav"
-        # convert sampling rate later
-        assert len(audio[start:end]) > 0, (full_word_path, start, end)
-        sf.write(segmented_path, audio[start:end], samplerate=sampling_rate)
-        return segmented_path
-    df['audio'] = df.apply(segment_audio, axis=1)
+    df['audio'], df['segment'] = segment_audio(df, VOXANGELES_PATH, num_workers=NUM_WORKERS)
 
     # prepare the answer
+        # one id per distinct middle phone, every label is a lookup in the phone feature table
+    mid_phones = df['phones'].str.split(' ').str[1]
+    mid_phone_ids, phone_inventory = pd.factorize(mid_phones)
+    table = phone_feature_table(list(phone_inventory), ft, dist, son)
 
     # phone classification - the phone
     phone_df = df.copy()
     # manner of articulation - both vowels, consonants
     manner_df = df.copy()
     # place of articulation - only consonants
-    vowels = df.apply(lambda sample: is_vowel(sample['phones'].split(' ')[1]), axis=1)
+    vowels = table["sonority"][mid_phone_ids] >= VOWEL_SONORITY
     place_df = df[~vowels].copy()
     # vowel height, frontness, roundedness - only vowels
     vowel_height_df, vowel_frontness_df, vowel_roundedness_df = df[vowels].copy(), df[vowels].copy(), df[vowels].copy()
 
-    phone_df['label'] = phone_df.apply(lambda row: row['phones'].split(' ')[1], axis=1)
+    phone_df['label'] = mid_phones
 
-    manner_df['label'] = manner_df.apply(lambda row: manner_of_articulation(row['phones'].split(' ')[1], ft), axis=1)
+    manner_df['label'] = table["manner"][mid_phone_ids]
     manner_df = manner_df[manner_df['label'].str.len() > 0]
 
-    place_df['label'] = place_df.apply(lambda row: place_of_articulation(row['phones'].split(' ')[1], ft, dist), axis=1)
+    place_df['label'] = table["place"][mid_phone_ids[~vowels]]
     place_df = place_df[place_df['label'].str.len() > 0]
 
-    vowel_height_df['label'] = vowel_height_df.apply(lambda row: vowel_height(row['phones'].split(' ')[1], ft), axis=1)
+    vowel_height_df['label'] = table["height"][mid_phone_ids[vowels]]
     vowel_height_df = vowel_height_df[vowel_height_df['label'].str.len() > 0]
 
-    vowel_frontness_df['label'] = vowel_frontness_df.apply(lambda row: vowel_frontness(row['phones'].split(' ')[1], ft), axis=1)
+    vowel_frontness_df['label'] = table["frontness"][mid_phone_ids[vowels]]
     vowel_frontness_df = vowel_frontness_df[vowel_frontness_df['label'].str.len() > 0]
 
-    vowel_roundedness_df['label'] = vowel_roundedness_df.apply(lambda row: vowel_roundedness(row['phones'].split(' ')[1], ft), axis=1)
+    vowel_roundedness_df['label'] = table["roundedness"][mid_phone_ids[vowels]]
     vowel_roundedness_df = vowel_roundedness_df[vowel_roundedness_df['label'].str.len() > 0]
 
+    # every variant is a selection of rows of one shared dataset of clips
+        # the audio is materialized and validated once, each variant only has its own label and instruction columns
+    shared = {"audio": df['audio'].tolist(), "file": df['segment'].tolist()}
+    positions = {}
     for task_name, instructions, dataframe in [("Phone", phone_classification_instructions, phone_df), \
         ("MannerOfArticulation", manner_classification_instructions, manner_df), \
-        ("ConsonantPlaceOfArticulation", place_classification_instructions, place_df), \
+        ("ConsonantPlaceOfArticulation", place_instructions(), place_df), \
         ("VowelFrontness", frontness_classification_instructions, vowel_frontness_df), \
         ("VowelHeight", height_classification_instructions, vowel_height_df), \
         ("VowelRoundedness", roundedness_classification_instructions, vowel_roundedness_df)]:
-        ds = Dataset.from_pandas(dataframe)
-
-        # Reformatting
-        def _map(sample, index):
-            return {
-                "audio": sample["audio"],
-                "file": sample["audio"],
-                "instruction": instructions[index % len(instructions)],
-                "label": sample["label"],
-            }
-        ds = ds.map(_map, with_indices=True, remove_columns=ds.column_names)
-        ds = ds.cast_column("audio", Audio(sampling_rate=16_000))
+        if task_name not in stale_tasks:
+            print(f"{task_name} is up to date")
+            continue
+
+        positions[task_name] = df.index.get_indexer(dataframe.index)
+        labels, task_instructions = np.full(len(df), None, dtype=object), np.full(len(df), None, dtype=object)
+        labels[positions[task_name]] = dataframe['label'].to_numpy()
+        task_instructions[positions[task_name]] = [instructions[index % len(instructions)] for index in range(len(dataframe))]
+        shared[f"label_{task_name}"], shared[f"instruction_{task_name}"] = labels.tolist(), task_instructions.tolist()
+
+    clips = cast_audio(Dataset.from_dict(shared), "audio")
+    durations = audio_durations(clips)
+
+    for task_name, rows in positions.items():
+        # an indices mapping over the shared clips, nothing is copied
+        ds = clips.select(rows) \
+            .select_columns(["audio", "file", f"instruction_{task_name}", f"label_{task_name}"]) \
+            .rename_columns({f"instruction_{task_name}": "instruction", f"label_{task_name}": "label"})
 
         # Validate & Push
-        validate_dataset(ds)
-        ds.push_to_hub(repo_id=f"DynamicSuperb/PhonologicalFeatureClassification_VoxAngeles-{task_name}", split="test", token=os.environ["HF_TOKEN"])
+        validate_dataset(ds, durations={"audio": durations[rows]})
+        export_dataset(ds, repo_id=_repo_id(task_name), split="test", inputs_hash=hashes[_repo_id(task_name)])
+
+if __name__ == "__main__":
+    build()
@@ -1,9 +1,7 @@
-import os
-import random
-from collections import defaultdict
+from pathlib import Path
 
-from datasets import load_dataset, Audio
-from utils import validate_dataset
+import numpy as np
+from utils import audio_durations, cast_audio, stratified_sample, validate_dataset, export_dataset, hash_inputs, needs_build, load_source, source_version
 
 first = [
     'Listen to the audio and count the number of phones present.',
@@ -42,13 +40,24 @@ second = [
 # Using list comprehension to generate the combined list
 instructions = [f + " " + s for f in first for s in second]
 
-if __name__ == "__main__":
-    ds = load_dataset(
-        "speech31/voxangeles",
-        cache_dir="datasets_cache",
-        revision="refs/convert/parquet",
-    )
-    new_ds = ds["test"]
+SOURCE = {"path": "speech31/voxangeles", "revision": "refs/convert/parquet", "split": "test", "cache_dir": "datasets_cache"}
+REPO_ID = "DynamicSuperb/PhoneSegmentCounting_VoxAngeles"
+
+
+def inputs_hashes():
+    return {REPO_ID: hash_inputs(source_version(SOURCE), Path(__file__))}
+
+
+def build(ds=None):
+    repo_id = REPO_ID
+    inputs_hash = inputs_hashes()[repo_id]
+    if not needs_build(repo_id, inputs_hash):
+        print(f"{repo_id} is up to date")
+        return
+
+    if ds is None:
+        ds = load_source(SOURCE)
+    new_ds = ds
 
     diacritics =  ["'", 'ʰ', 'ʱ', 'ʲ', 'ʷ', 'ʼ', 'ˀ', 'ˁ', 'ː', '˞', 
     'ˠ', 'ˢ', 'ˤ', '˭', '̃', '̄', '̆', '̈', '̘', '̙', '̚', '̜', 
@@ -71,19 +80,12 @@ if __name__ == "__main__":
     new_ds = new_ds.filter(lambda sample: 1 < sample["label"])
 
     # Filter out samples longer than 2 seconds
-    new_ds = new_ds.filter(lambda sample: len(sample["audio"]["array"]) / sample["audio"]["sampling_rate"] <= 2)
-
-    # Categorize the samples by their lengths
-    length_categories = defaultdict(list)
-    for i, sample in enumerate(new_ds):
-        length_categories[sample["label"]].append(i)
+    durations = audio_durations(new_ds, cache_dir="datasets_cache")
+    new_ds = new_ds.select(np.flatnonzero(durations <= 2))
 
     # Randomly select 60% of the samples for each length
-    selected_indices = []
-    for i, (length, indices) in enumerate(sorted(length_categories.items())):
-        num_to_select = int(len(indices) * 0.6)
-        random.seed(i)
-        selected_indices.extend(random.sample(indices, num_to_select))
+    #   only the length column is read, audio is never decoded
+    selected_indices = stratified_sample(new_ds, "label", 0.6)
 
     # Create a new dataset with the selected indices
     new_ds = new_ds.select(selected_indices)
@@ -96,9 +98,13 @@ if __name__ == "__main__":
             "instruction": instructions[index % len(instructions)],
             "label": str(sample["label"]),
         }
-    new_ds = new_ds.map(_map, with_indices=True, remove_columns=ds["test"].column_names)
-    new_ds = new_ds.cast_column("audio", Audio(sampling_rate=16_000))
+    new_ds = new_ds.map(_map, with_indices=True, remove_columns=ds.column_names)
+    new_ds = cast_audio(new_ds, "audio")
 
     # Validate & Push
     validate_dataset(new_ds)
-    new_ds.push_to_hub(repo_id="DynamicSuperb/PhoneSegmentCounting_VoxAngeles", split="test", token=os.environ["HF_TOKEN"])
+    export_dataset(new_ds, repo_id=repo_id, split="test", inputs_hash=inputs_hash)
+
+
+if __name__ == "__main__":
+    build()
@@ -1,15 +1,27 @@
+import hashlib
+import json
 import os
+from pathlib import Path
 import numpy as np
-from datasets import load_dataset, Audio, Dataset
-import stanza
+from datasets import Audio
+import pyarrow.compute as pc
 from string import punctuation
-from utils import validate_dataset
-from collections import defaultdict
-import pandas as pd
+from utils import cast_audio, validate_dataset, export_dataset, hash_inputs, needs_build, load_source, source_version
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from importlib.metadata import version
 
-# Initialize the stanza pipeline to use GPU
-stanza.download('en')
-nlp = stanza.Pipeline('en', use_gpu=True)
+# only the processors the labels need
+TAG_PROCESSORS = "tokenize,mwt,pos"
+
+# tagged sentences of every text, keyed by text hash, shared by both tasks and reruns
+TAG_CACHE_PATH = Path("datasets_cache/stanza_tags.json")
+# documents per bulk_process call
+TAG_BATCH_SIZE = 256
+# on build nodes without a GPU, tag on this many worker processes (each with its own CPU pipeline) instead,
+# using TAG_NUM_THREADS threads each
+TAG_NUM_WORKERS = int(os.environ.get("TAG_NUM_WORKERS", 0))
+TAG_NUM_THREADS = int(os.environ.get("TAG_NUM_THREADS", 1))
 
 TAG_DESCRIPTION = "The tags include ADJ, ADP, ADV, AUX, CCONJ, DET, INTJ, NOUN, NUM, PART, PRON, PROPN, SCONJ, and VERB."
 
@@ -77,9 +89,8 @@ def filter_text(text):
         return None
     return text.strip()
 
-def sent_and_tag(text):
-    doc = nlp(text)
-    sent_and_tags = [
+def _sent_and_tags(doc):
+    return [
         (
             " ".join([word.text for word in sentence.words if word.text not in punctuation]),
             " ".join([word.upos for word in sentence.words if word.text not in punctuation]),
@@ -87,36 +98,120 @@ def sent_and_tag(text):
         )
         for sentence in doc.sentences
     ]
-    return sent_and_tags
+
+@lru_cache(maxsize=None)
+def download_models():
+    import stanza
+    stanza.download('en')
+
+@lru_cache(maxsize=None)
+def stanza_pipeline():
+    # Initialize the stanza pipeline to use GPU, on first use rather than at import
+    import stanza
+    download_models()
+    return stanza.Pipeline('en', processors=TAG_PROCESSORS, use_gpu=True)
+
+def sent_and_tag(text):
+    return _sent_and_tags(stanza_pipeline()(text))
+
+def _tag_cache_key():
+    return {"stanza": version("stanza"), "processors": TAG_PROCESSORS}
+
+def _init_tag_worker(num_threads):
+    global _worker_nlp
+    import stanza
+    import torch
+    torch.set_num_threads(num_threads)
+    _worker_nlp = stanza.Pipeline('en', processors=TAG_PROCESSORS, use_gpu=False)
+
+def _tag_shard(texts):
+    return [[[sentence, tag] for sentence, tag, _ in _sent_and_tags(doc)] for doc in _worker_nlp.bulk_process(texts)]
+
+def tag_texts(texts, batch_size=TAG_BATCH_SIZE, num_workers=TAG_NUM_WORKERS, num_threads=TAG_NUM_THREADS):
+    """
+    sent_and_tag for many texts, as a dict from text to its (sentence, tags, tag list) triples
+    Results are cached on disk by text hash; missing texts are tagged with bulk_process in batches of documents,
+    or, with num_workers > 0, the batches are spread over CPU worker processes and merged back in order
+    """
+    cache = {}
+    if TAG_CACHE_PATH.exists():
+        stored = json.loads(TAG_CACHE_PATH.read_text())
+        if stored["key"] == _tag_cache_key():
+            cache = stored["tags"]
+
+    text_hashes = {text: hashlib.sha256(text.encode()).hexdigest() for text in texts}
+    missing = [text for text in dict.fromkeys(texts) if text_hashes[text] not in cache]
+    batches = [missing[start:start + batch_size] for start in range(0, len(missing), batch_size)]
+    if num_workers > 0 and batches:
+        # download once here, not in every worker
+        download_models()
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_tag_worker, initargs=(num_threads,)) as executor:
+            for batch, tags in zip(batches, executor.map(_tag_shard, batches)):
+                cache.update(zip([text_hashes[text] for text in batch], tags))
+    else:
+        for batch in batches:
+            for text, doc in zip(batch, stanza_pipeline().bulk_process(batch)):
+                cache[text_hashes[text]] = [[sentence, tag] for sentence, tag, _ in _sent_and_tags(doc)]
+
+    if missing:
+        TAG_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = TAG_CACHE_PATH.with_suffix(f".{os.getpid()}.tmp")
+        tmp_path.write_text(json.dumps({"key": _tag_cache_key(), "tags": cache}))
+        os.replace(tmp_path, TAG_CACHE_PATH)
+    return {text: [(sentence, tag, tag.split()) for sentence, tag in cache[text_hashes[text]]] for text in texts}
 
 def contains_sym_x(pos_tags):
     return any(tag in ['SYM', 'X'] for tag in pos_tags)
 
-if __name__ == "__main__":
-    ds = load_dataset(
-        "mythicinfinity/libritts", "clean", split="test.clean",
-        cache_dir="/data/user_data/eyeo2",
-    )
+SOURCE = {"path": "mythicinfinity/libritts", "name": "clean", "split": "test.clean", "cache_dir": "/data/user_data/eyeo2"}
+POS_REPO_ID = "DynamicSuperb/PoS_Estimation_LibriTTS_PoS"
+TRANS_REPO_ID = "DynamicSuperb/PoS_Estimation_LibriTTS_PoS_with_transcription"
+
+
+def inputs_hashes():
+    source = source_version(SOURCE)
+    return {
+        POS_REPO_ID: hash_inputs(source, Path(__file__), INSTRUCTIONS_POS),
+        TRANS_REPO_ID: hash_inputs(source, Path(__file__), INSTRUCTIONS_TRANS),
+    }
+
+
+def build(ds=None):
+    pos_repo_id, trans_repo_id = POS_REPO_ID, TRANS_REPO_ID
+    hashes = inputs_hashes()
+    pos_inputs_hash, trans_inputs_hash = hashes[pos_repo_id], hashes[trans_repo_id]
+    build_pos, build_trans = needs_build(pos_repo_id, pos_inputs_hash), needs_build(trans_repo_id, trans_inputs_hash)
+    if not (build_pos or build_trans):
+        print("PoS tasks are up to date")
+        return
+
+    if ds is None:
+        ds = load_source(SOURCE)
 
     # Filter sentences by text length and group by text length
-    samples_by_length = defaultdict(list)
-    for sample in ds:
-        text_length = len(sample['text_normalized'].split())
-        if 3 <= text_length <= 15:
-            samples_by_length[text_length].append(sample)
+        # only the text column is read, the audio is never decoded
+    texts = ds.select_columns(["text_normalized"]).with_format("arrow")[:]["text_normalized"]
+    text_lengths = pc.list_value_length(pc.utf8_split_whitespace(pc.utf8_trim_whitespace(texts))).to_numpy()
+    in_range = np.flatnonzero((3 <= text_lengths) & (text_lengths <= 15))
+    # lengths in order of first appearance, rows in dataset order
+    indices_by_length = {int(length): in_range[text_lengths[in_range] == length] for length in dict.fromkeys(text_lengths[in_range])}
 
     # Determine the minimum number of samples for any text length
-    min_samples = min(len(samples) for samples in samples_by_length.values())
+    min_samples = min(len(indices) for indices in indices_by_length.values())
     print(f"Minimum number of samples for any text length: {min_samples}")
 
     # Select the same number of samples for each text length
-    balanced_samples = []
-    for length, samples in samples_by_length.items():
-        balanced_samples.extend(samples[:min_samples])
+    balanced_indices = []
+    for length, indices in indices_by_length.items():
+        balanced_indices.extend(indices[:min_samples])
         print(f"Selected {min_samples} samples for length {length}")
 
-    # Convert list to Dataset
-    new_ds = Dataset.from_pandas(pd.DataFrame(balanced_samples))
+    # audio stays encoded, it is only passed through to the output datasets
+    new_ds = ds.select(balanced_indices).cast_column("audio", Audio(decode=False))
+
+    # tag every text once, both tasks read their labels from the same results
+    texts = [filter_text(text) for text in new_ds["text_normalized"]]
+    tagged = tag_texts([text for text in texts if text is not None])
 
     def _map(sample, index, instructions, with_transcription=False):
         text = filter_text(sample['text_normalized'])
@@ -128,7 +223,7 @@ if __name__ == "__main__":
                 "label": ""
             }
 
-        sent_and_tags = sent_and_tag(text)
+        sent_and_tags = tagged[text]
         if any(contains_sym_x(tags) for _, _, tags in sent_and_tags):
             return {
                 "audio": sample["audio"],
@@ -149,18 +244,24 @@ if __name__ == "__main__":
             "label": label
         }
 
-    new_ds_pos = new_ds.map(lambda sample, index: _map(sample, index, INSTRUCTIONS_POS, with_transcription=False), with_indices=True, remove_columns=new_ds.column_names)
-    new_ds_pos = new_ds_pos.filter(lambda x: "label" in x and x["label"] != "")
-    new_ds_pos = new_ds_pos.cast_column("audio", Audio(sampling_rate=16_000))
+    if build_pos:
+        new_ds_pos = new_ds.map(lambda sample, index: _map(sample, index, INSTRUCTIONS_POS, with_transcription=False), with_indices=True, remove_columns=new_ds.column_names)
+        new_ds_pos = new_ds_pos.filter(lambda x: "label" in x and x["label"] != "")
+        new_ds_pos = cast_audio(new_ds_pos, "audio")
+
+        # Validate & Push
+        validate_dataset(new_ds_pos)
+        export_dataset(new_ds_pos, repo_id=pos_repo_id, split="test", inputs_hash=pos_inputs_hash)
 
-    # Validate & Push
-    validate_dataset(new_ds_pos)
-    new_ds_pos.push_to_hub(repo_id="DynamicSuperb/PoS_Estimation_LibriTTS_PoS", split="test", token=os.environ["HF_TOKEN"])
+    if build_trans:
+        new_ds_trans = new_ds.map(lambda sample, index: _map(sample, index, INSTRUCTIONS_TRANS, with_transcription=True), with_indices=True, remove_columns=new_ds.column_names)
+        new_ds_trans = new_ds_trans.filter(lambda x: "label" in x and x["label"] != "")
+        new_ds_trans = cast_audio(new_ds_trans, "audio")
 
-    new_ds_trans = new_ds.map(lambda sample, index: _map(sample, index, INSTRUCTIONS_TRANS, with_transcription=True), with_indices=True, remove_columns=new_ds.column_names)
-    new_ds_trans = new_ds_trans.filter(lambda x: "label" in x and x["label"] != "")
-    new_ds_trans = new_ds_trans.cast_column("audio", Audio(sampling_rate=16_000))
+        # Validate & Push
+        validate_dataset(new_ds_trans)
+        export_dataset(new_ds_trans, repo_id=trans_repo_id, split="test", inputs_hash=trans_inputs_hash)
 
-    # Validate & Push
-    validate_dataset(new_ds_trans)
-    new_ds_trans.push_to_hub(repo_id="DynamicSuperb/PoS_Estimation_LibriTTS_PoS_with_transcription", split="test", token=os.environ["HF_TOKEN"])
+
+if __name__ == "__main__":
+    build()
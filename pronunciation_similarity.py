@@ -1,10 +1,17 @@
+import json
 import os
 import random
+import unicodedata
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from importlib.metadata import version
+from pathlib import Path
 
-from datasets import Dataset, load_dataset, Audio
-from utils import validate_dataset
-from panphon.distance import Distance
+import numpy as np
+import pyarrow as pa
+from datasets import Dataset
+from utils import audio_durations, cast_audio, take_rows, panphon_distance, validate_dataset, export_dataset, hash_inputs, needs_build, load_source, source_version
 from tqdm import tqdm
 
 
@@ -16,6 +23,18 @@ FAR_UPPER_BOUND = 0.8
 
 DEBUG = True
 
+# worker processes for the per-language distance and triplet indexing
+NUM_WORKERS = 8
+
+# per-language feature edit distance matrices, reused across reruns and threshold sweeps
+DISTANCE_CACHE_DIR = Path("datasets_cache/feature_edit_distance")
+
+# languages with at least this many words are indexed with a VP-tree instead of the full distance matrix
+METRIC_INDEX_MIN_WORDS = 3000
+VP_TREE_LEAF_SIZE = 32
+# slack on the triangle inequality bounds, so that float rounding never prunes a word within a band
+VP_TREE_EPS = 1e-9
+
 instructions_command = [
     "Based on the three audio files (A, B, X), determine whether word X is closer in pronunciation to word A or word B.",
     "Please determine whether word X is closer in pronunciation to word A or word B given the three audio files (A, B, X).",
@@ -54,10 +73,258 @@ answer_format = [
 instructions = [command + ' ' + answer_f for answer_f in answer_format for command in instructions_command]
 
 
-def generate_triplets(filenames, words, dist):
+def segment_tables(words, dist):
+    """
+    Convert each word to panphon feature vectors once: returns the padded segment ids and lengths of the words,
+    and the insertion/deletion and substitution costs of every distinct segment
+    """
+    # panphon's own cost functions on each distinct segment, so that the numbers are exactly the same
+    segment_ids = {}
+    word_segments = []
+    for word in words:
+        vectors = dist.fm.word_to_vector_list(word, numeric=True) if word else []
+        word_segments.append([segment_ids.setdefault(tuple(v), len(segment_ids)) for v in vectors])
+    # the last segment id is used as padding
+    segments = [list(v) for v in segment_ids] + [[0]]
+    num_segments = len(segments)
+    indel_cost = np.array([dist.unweighted_deletion_cost(v) for v in segments[:-1]] + [0.0])
+    sub_cost = np.zeros((num_segments, num_segments))
+    for u in range(num_segments - 1):
+        for v in range(num_segments - 1):
+            sub_cost[u, v] = dist.unweighted_substitution_cost(segments[u], segments[v])
+
+    max_len = max([len(s) for s in word_segments], default=0)
+    lengths = np.array([len(s) for s in word_segments], dtype=np.int64)
+    padded = np.full((len(words), max_len), num_segments - 1, dtype=np.int64)
+    for i, s in enumerate(word_segments):
+        padded[i, :len(s)] = s
+    return padded, lengths, indel_cost, sub_cost
+
+
+def pair_distances(tables, src, tgt, chunk_size=20_000):
+    """
+    Feature edit distances between words src[p] and tgt[p] (indices into segment_tables)
+    The DP of every pair is run at the same time, one anti-diagonal per step
+    """
+    padded, lengths, indel_cost, sub_cost = tables
+    max_len = padded.shape[1]
+    distances = np.zeros(len(src))
+    for start in range(0, len(src), chunk_size):
+        src_chunk, tgt_chunk = src[start:start + chunk_size], tgt[start:start + chunk_size]
+        src_segs, tgt_segs = padded[src_chunk], padded[tgt_chunk]
+        # d[p, i, j] = distance between the first i segments of the source and the first j of the target
+        d = np.zeros((len(src_chunk), max_len + 1, max_len + 1))
+        for i in range(1, max_len + 1):
+            d[:, i, 0] = d[:, i - 1, 0] + indel_cost[src_segs[:, i - 1]]
+            d[:, 0, i] = d[:, 0, i - 1] + indel_cost[tgt_segs[:, i - 1]]
+        for k in range(2, 2 * max_len + 1):
+            ii = np.arange(max(1, k - max_len), min(max_len, k - 1) + 1)
+            jj = k - ii
+            src_k, tgt_k = src_segs[:, ii - 1], tgt_segs[:, jj - 1]
+            d[:, ii, jj] = np.minimum(np.minimum(
+                d[:, ii - 1, jj] + indel_cost[src_k],
+                d[:, ii - 1, jj - 1] + sub_cost[src_k, tgt_k]),
+                d[:, ii, jj - 1] + indel_cost[tgt_k])
+        distances[start:start + chunk_size] = d[np.arange(len(src_chunk)), lengths[src_chunk], lengths[tgt_chunk]]
+    return distances
+
+
+def feature_edit_distance_matrix(words, dist, chunk_size=20_000):
+    """
+    All-pairs dist.feature_edit_distance for a list of words
+    The distance is symmetric, so only i < j is computed
+    """
+    tables = segment_tables(words, dist)
+    rows, cols = np.triu_indices(len(words), k=1)
+    distances = pair_distances(tables, rows, cols, chunk_size)
+    matrix = np.zeros((len(words), len(words)))
+    matrix[rows, cols] = distances
+    matrix[cols, rows] = distances
+    return matrix
+
+
+def build_vp_tree(tables, leaf_size=VP_TREE_LEAF_SIZE, seed=0):
+    """
+    Vantage-point tree over the words of segment_tables
+    Nodes are ("leaf", indices) or ("node", vp, [(lo, hi, child), ...]),
+    where every word in child is between lo and hi away from the vantage point vp
+    """
+    rng = np.random.default_rng(seed)
+
+    def build(indices):
+        if len(indices) <= leaf_size:
+            return ("leaf", indices)
+        vp = indices[rng.integers(len(indices))]
+        rest = indices[indices != vp]
+        d = pair_distances(tables, np.full(len(rest), vp), rest)
+        inside = d <= np.median(d)
+        if inside.all():
+            # every word is equally far from vp, so there is nothing to split on
+            return ("leaf", indices)
+        children = [(d[mask].min(), d[mask].max(), build(rest[mask])) for mask in (inside, ~inside)]
+        return ("node", vp, children)
+
+    return build(np.arange(len(tables[1])))
+
+
+def range_queries(tables, tree, queries, bands):
+    """
+    For every band (lower, upper), the (target, query) pairs with lower <= distance <= upper, sorted by target
+    All queries walk the tree together, level by level, so that each level is a single pair_distances call
+    Subtrees are pruned with the triangle inequality |d(x, vp) - d(y, vp)| <= d(x, y) <= d(x, vp) + d(y, vp)
+    """
+    hits = [[] for _ in bands]
+    frontier = [(np.asarray(queries), tree)]
+    while frontier:
+        # every node on the frontier needs the distances from its queries to its vantage point or leaf words
+        src, tgt = [], []
+        for x, node in frontier:
+            targets = node[1] if node[0] == "leaf" else np.array([node[1]])
+            src.append(np.repeat(x, len(targets)))
+            tgt.append(np.tile(targets, len(x)))
+        d = pair_distances(tables, np.concatenate(src), np.concatenate(tgt))
+
+        next_frontier, start = [], 0
+        for (x, node), s, t in zip(frontier, src, tgt):
+            d_node = d[start:start + len(s)]
+            start += len(s)
+            for hit, (lower, upper) in zip(hits, bands):
+                mask = (lower <= d_node) & (d_node <= upper) & (s != t)
+                hit.append(np.stack([t[mask], s[mask]], axis=1))
+            if node[0] == "leaf":
+                continue
+            for lo, hi, child in node[2]:
+                min_d, max_d = np.maximum(np.maximum(lo - d_node, d_node - hi), 0), d_node + hi
+                keep = np.zeros(len(x), dtype=bool)
+                for lower, upper in bands:
+                    keep |= (min_d <= upper + VP_TREE_EPS) & (max_d >= lower - VP_TREE_EPS)
+                if keep.any():
+                    next_frontier.append((x[keep], child))
+        frontier = next_frontier
+
+    pairs = [np.concatenate(hit) for hit in hits]
+    return [p[np.lexsort((p[:, 1], p[:, 0]))] for p in pairs]
+
+
+def _distance_cache_key():
+    return {"panphon": version("panphon"), "distance": "feature_edit_distance"}
+
+
+def _write_atomic(path, write):
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def _load_distance_cache(lang):
+    vocab_path, matrix_path = DISTANCE_CACHE_DIR / f"{lang}.json", DISTANCE_CACHE_DIR / f"{lang}.npy"
+    if not (vocab_path.exists() and matrix_path.exists()):
+        return [], None
+    cache = json.loads(vocab_path.read_text())
+    if cache["key"] != _distance_cache_key():
+        return [], None
+    return cache["words"], np.load(matrix_path, mmap_mode="r")
+
+
+def cached_distance_matrix(lang, words, dist):
+    """
+    feature_edit_distance_matrix(words, dist), served from a memory-mapped matrix per language
+    Entries are keyed by the NFD-normalized words (as panphon normalizes them), the panphon version and the distance type;
+    the matrix is recomputed over the extended vocabulary whenever new words are requested
+    """
+    words = [unicodedata.normalize("NFD", w) for w in words]
+    vocab, matrix = _load_distance_cache(lang)
+    index = {w: i for i, w in enumerate(vocab)}
+    new_words = [w for w in dict.fromkeys(words) if w not in index]
+    if new_words or matrix is None:
+        vocab = vocab + new_words
+        index = {w: i for i, w in enumerate(vocab)}
+        DISTANCE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # the vocabulary is written last, it marks the matrix as complete
+        _write_atomic(DISTANCE_CACHE_DIR / f"{lang}.npy", lambda f: np.save(f, feature_edit_distance_matrix(vocab, dist)))
+        _write_atomic(DISTANCE_CACHE_DIR / f"{lang}.json", lambda f: f.write(json.dumps({"key": _distance_cache_key(), "words": vocab}).encode()))
+        _, matrix = _load_distance_cache(lang)
+
+    rows = np.array([index[w] for w in words], dtype=np.int64)
+    return matrix[np.ix_(rows, rows)]
+
+
+@lru_cache(maxsize=None)
+def _distance_lookup(lang):
+    vocab, matrix = _load_distance_cache(lang)
+    return {w: i for i, w in enumerate(vocab)}, matrix
+
+
+def cached_feature_edit_distance(lang, w1, w2, dist):
+    """
+    dist.feature_edit_distance(w1, w2) read from the language's distance cache, computed only if missing
+    """
+    index, matrix = _distance_lookup(lang)
+    w1, w2 = unicodedata.normalize("NFD", w1), unicodedata.normalize("NFD", w2)
+    if w1 in index and w2 in index:
+        return float(matrix[index[w1], index[w2]])
+    return dist.feature_edit_distance(w1, w2)
+
+
+def index_triplets(words, dist, lang=None):
+    """
+    Index the ABX candidates of one language: the close (A, X) pairs and, for every X, the words B with (B, X) far
+    """
+    words = list(dict.fromkeys(w for w in words if w))
+    if len(words) >= METRIC_INDEX_MIN_WORDS:
+        # n^2 distances are too many for large vocabularies, only the words within the bands are searched for
+        tables = segment_tables(words, dist)
+        close_pairs, far_pairs = range_queries(
+            tables, build_vp_tree(tables), np.arange(len(words)),
+            [(CLOSE_LOWER_BOUND, CLOSE_UPPER_BOUND), (FAR_LOWER_BOUND, FAR_UPPER_BOUND)],
+        )
+        # (B, X) pairs sorted by X then B, split by X
+        far_pairs = far_pairs[np.lexsort((far_pairs[:, 0], far_pairs[:, 1]))]
+        splits = np.searchsorted(far_pairs[:, 1], np.arange(1, len(words)))
+        return words, close_pairs, np.split(far_pairs[:, 0], splits)
+
+    fed = cached_distance_matrix(lang, words, dist) if lang else feature_edit_distance_matrix(words, dist)
+    # a word is never paired with itself
+    np.fill_diagonal(fed, np.nan)
+
+    # find close word pairs (CLOSE_LOWER_BOUND <= dist <= CLOSE_UPPER_BOUND)
+    close_pairs = np.argwhere((CLOSE_LOWER_BOUND <= fed) & (fed <= CLOSE_UPPER_BOUND))
+    # find far word pairs (FAR_LOWER_BOUND <= dist <= FAR_UPPER_BOUND), indexed by X
+    far = (FAR_LOWER_BOUND <= fed) & (fed <= FAR_UPPER_BOUND)
+    far_by_x = [np.flatnonzero(far[:, x]) for x in range(len(words))]
+    return words, close_pairs, far_by_x
+
+
+def _init_worker(dist):
+    global _worker_dist
+    _worker_dist = dist
+
+
+def _index_triplets_worker(lang, words):
+    return index_triplets(words, _worker_dist, lang=lang)
+
+
+def index_languages(lang_to_words, dist, num_workers=1):
     """
-    Generate ABX (ordered) triplets of filenames within each language
+    index_triplets for every language, yielded in the order of lang_to_words
+    With num_workers > 1 the languages are spread over worker processes, so the results are the same as a serial run
     """
+    if num_workers <= 1:
+        for lang, words in tqdm(lang_to_words.items()):
+            yield index_triplets(words, dist, lang=lang)
+        return
+
+    with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=(dist,)) as executor:
+        # submit the largest languages first so that no worker is left with a big one at the end
+        futures = {}
+        for lang in sorted(lang_to_words, key=lambda lang: len(lang_to_words[lang]), reverse=True):
+            futures[lang] = executor.submit(_index_triplets_worker, lang, lang_to_words[lang])
+        for lang in tqdm(lang_to_words):
+            yield futures[lang].result()
+
+
+def _group_by_language(filenames, words):
     # example filename: nan-004-028
     # example word: tsiʔ
     lang_to_words = defaultdict(list)
@@ -67,47 +334,71 @@ def generate_triplets(filenames, words, dist):
         word = words[i]
         lang_to_words[lang].append(word)
         word_to_file[word] = filename
+    return lang_to_words, word_to_file
 
-    triplets = []
-    for lang, words in tqdm(lang_to_words.items()):
-        # compute feature edit distance between every other word
-        fed = defaultdict(float)
-        pairs = set()
-        for i, w1 in enumerate(words):
-            for j, w2 in enumerate(words):
-                if w1 and w2 and i != j:
-                    fed[(w1, w2)] = dist.feature_edit_distance(w1, w2)
-                    pairs.add((w1, w2))
-
-        # find close word pairs (CLOSE_LOWER_BOUND <= dist <= CLOSE_UPPER_BOUND)
-        close_pairs = [(w1, w2) for (w1, w2) in pairs \
-            if CLOSE_LOWER_BOUND <= fed[(w1, w2)] <= CLOSE_UPPER_BOUND ]
-        # find far word pairs (FAR_LOWER_BOUND <= dist <= FAR_UPPER_BOUND)
-        far_pairs = [(w1, w2) for (w1, w2) in pairs \
-            if FAR_LOWER_BOUND <= fed[(w1, w2)] <= FAR_UPPER_BOUND ]
-
-        # then create (A, B, X) triplets
-            # (A, X) = close_pair then find all (B, X) in far_pair
-        for (A, X) in close_pairs:
-            for (B, _) in [(w1, w2) for (w1, w2) in far_pairs if X == w2]:
-                file_A = word_to_file[A]
-                file_B = word_to_file[B]
-                file_X = word_to_file[X]
-                triplets.append((file_A, file_B, file_X))
+
+def generate_triplets(filenames, words, dist, num_workers=1):
+    """
+    Lazily generate ABX (ordered) triplets of filenames within each language
+    """
+    lang_to_words, word_to_file = _group_by_language(filenames, words)
+    for lang_words, close_pairs, far_by_x in index_languages(lang_to_words, dist, num_workers):
+        # (A, X) = close_pair then find all (B, X) in far_pair
+        for a, x in close_pairs:
+            for b in far_by_x[x]:
+                yield (word_to_file[lang_words[a]], word_to_file[lang_words[b]], word_to_file[lang_words[x]])
 
         # does not duplicate cases where A and B are swapped
+    # 127,743 triplets
+
+
+def sample_triplets(filenames, words, dist, k, num_workers=1):
+    """
+    Same as random.sample(list(generate_triplets(...)), k), without materializing every triplet:
+    the triplets are counted, random.sample picks k positions (consuming the same random state),
+    then a single pass over the indexes emits the picked triplets
+    """
+    lang_to_words, word_to_file = _group_by_language(filenames, words)
+    indexes = list(index_languages(lang_to_words, dist, num_workers))
+    total = sum(sum(len(far_by_x[x]) for _, x in close_pairs) for _, close_pairs, far_by_x in indexes)
+
+    positions = random.sample(range(total), k)
+    slots = {position: slot for slot, position in enumerate(positions)}
+    sorted_positions = sorted(positions)
 
+    triplets = [None] * k
+    offset, next_pick = 0, 0
+    for lang_words, close_pairs, far_by_x in indexes:
+        for a, x in close_pairs:
+            block = far_by_x[x]
+            # skip whole (A, X) blocks that contain no picked position
+            while next_pick < k and sorted_positions[next_pick] < offset + len(block):
+                position = sorted_positions[next_pick]
+                b = block[position - offset]
+                triplets[slots[position]] = (word_to_file[lang_words[a]], word_to_file[lang_words[b]], word_to_file[lang_words[x]])
+                next_pick += 1
+            offset += len(block)
     return triplets
-    # 127,743 triplets
 
 
-if __name__ == "__main__":
-    ds = load_dataset(
-        "speech31/voxangeles",
-        cache_dir="datasets_cache",
-        revision="refs/convert/parquet",
-    )
-    new_ds = ds["test"]
+SOURCE = {"path": "speech31/voxangeles", "revision": "refs/convert/parquet", "split": "test", "cache_dir": "datasets_cache"}
+REPO_ID = "kalbin/MultilingualPronunciationSimilarity_VoxAngeles"
+
+
+def inputs_hashes():
+    return {REPO_ID: hash_inputs(source_version(SOURCE), Path(__file__))}
+
+
+def build(ds=None):
+    repo_id = REPO_ID
+    inputs_hash = inputs_hashes()[repo_id]
+    if not needs_build(repo_id, inputs_hash):
+        print(f"{repo_id} is up to date")
+        return
+
+    if ds is None:
+        ds = load_source(SOURCE)
+    new_ds = ds
 
     # multilingual pronunciation similarity
         # A,B,X from the same language
@@ -116,75 +407,59 @@ if __name__ == "__main__":
     random.seed(15213)
 
     # Filter out samples longer than 2 seconds
-    new_ds = new_ds.filter(lambda sample: len(sample["audio"]["array"]) / sample["audio"]["sampling_rate"] <= 2)
+    durations = audio_durations(new_ds, cache_dir="datasets_cache")
+    new_ds = new_ds.select(np.flatnonzero(durations <= 2))
 
     # ensure no transcriptions are nan
     new_ds = new_ds.filter(lambda sample: sample["word"] is not None)
 
     # get indices
-    file_to_index = defaultdict(str)
-    for i, ex in enumerate(new_ds):
-        file_to_index[ex["file"]] = i
-
-    # columns: file1, audio1; file2, audio2; file3, audio3
-    rows = defaultdict(list)
+    file_to_index = {file: i for i, file in enumerate(new_ds["file"])}
 
     # aim for 1000 examples (approx 1 hour)
-    dist = Distance()
-    triplets = generate_triplets(new_ds["file"], new_ds["word"], dist)
-    triplets = random.sample(triplets, 1000)
+    dist = panphon_distance()
+    triplets = sample_triplets(new_ds["file"], new_ds["word"], dist, 1000, num_workers=NUM_WORKERS)
 
     # randomly shuffle A and B so the answer is not always A
     answer_is_B = set(random.sample(range(1000), 500))
     triplets = [(B_f, A_f, X_f) if i in answer_is_B else (A_f, B_f, X_f) for i, (A_f, B_f, X_f) in enumerate(triplets)]
 
-    for i, (file1, file2, file3) in tqdm(enumerate(triplets)):
-        rows["label"].append("B" if i in answer_is_B else "A")
-
-        rows["file"].append(file1)
-        file1_ex = new_ds[file_to_index[file1]]
-        rows["audio"].append(file1_ex["audio"])
-        # the phones for the word, e.g. "kaʊ"
-        rows["word1"].append(file1_ex["word"])
-
-        rows["file2"].append(file2)
-        file2_ex = new_ds[file_to_index[file2]]
-        rows["audio2"].append(file2_ex["audio"])
-        rows["word2"].append(file2_ex["word"])
-
-        rows["file3"].append(file3)
-        file3_ex = new_ds[file_to_index[file3]]
-        rows["audio3"].append(file3_ex["audio"])
-        rows["word3"].append(file3_ex["word"])
-    new_ds = Dataset.from_dict(rows)
-
-    # Reformatting
-    def _map(sample, index):
-        A, B, X = sample["word1"], sample["word2"], sample["word3"]
-        final_keys = {
-            "audio": sample["audio"],
-            "file": sample["file"],
-            "audio2": sample["audio2"],
-            "file2": sample["file2"],
-            "audio3": sample["audio3"],
-            "file3": sample["file3"],
-            "instruction": instructions[index % len(instructions)],
-            "label": sample["label"],
-        }
-        if DEBUG:
-            # for debugging
-            final_keys["dist_A_X"] = dist.feature_edit_distance(A, X)
-            final_keys["dist_B_X"] = dist.feature_edit_distance(B, X)
-            final_keys["A"] = A
-            final_keys["B"] = B
-            final_keys["X"] = X
-        return final_keys
-    new_ds = new_ds.map(_map, with_indices=True, remove_columns=new_ds.column_names)
-    new_ds = new_ds.cast_column("audio", Audio(sampling_rate=16_000))
-    new_ds = new_ds.cast_column("audio2", Audio(sampling_rate=16_000))
-    new_ds = new_ds.cast_column("audio3", Audio(sampling_rate=16_000))
+    # gather the A, B and X rows with one Arrow take each, without decoding any audio
+    A_rows, B_rows, X_rows = [
+        take_rows(new_ds, [file_to_index[triplet[position]] for triplet in triplets], ["file", "audio", "word"])
+        for position in range(3)
+    ]
+    # columns: audio, file; audio2, file2; audio3, file3
+    columns = {
+        "audio": A_rows["audio"],
+        "file": A_rows["file"],
+        "audio2": B_rows["audio"],
+        "file2": B_rows["file"],
+        "audio3": X_rows["audio"],
+        "file3": X_rows["file"],
+        "instruction": pa.array([instructions[i % len(instructions)] for i in range(len(triplets))]),
+        "label": pa.array(["B" if i in answer_is_B else "A" for i in range(len(triplets))]),
+    }
+    if DEBUG:
+        # for debugging
+        # the phones for the words, e.g. "kaʊ"
+        A, B, X = A_rows["word"].to_pylist(), B_rows["word"].to_pylist(), X_rows["word"].to_pylist()
+        langs = [file3.split('-')[0] for file3 in X_rows["file"].to_pylist()]
+        columns["dist_A_X"] = pa.array([cached_feature_edit_distance(lang, a, x, dist) for lang, a, x in zip(langs, A, X)])
+        columns["dist_B_X"] = pa.array([cached_feature_edit_distance(lang, b, x, dist) for lang, b, x in zip(langs, B, X)])
+        columns["A"] = pa.array(A)
+        columns["B"] = pa.array(B)
+        columns["X"] = pa.array(X)
+    new_ds = Dataset(pa.table(columns))
+    new_ds = cast_audio(new_ds, "audio")
+    new_ds = cast_audio(new_ds, "audio2")
+    new_ds = cast_audio(new_ds, "audio3")
 
     # Validate & Push
     if not DEBUG:
         validate_dataset(new_ds)
-    new_ds.push_to_hub(repo_id="kalbin/MultilingualPronunciationSimilarity_VoxAngeles", split="test", token=os.environ["HF_TOKEN"])
+    export_dataset(new_ds, repo_id=repo_id, split="test", inputs_hash=inputs_hash)
+
+
+if __name__ == "__main__":
+    build()
@@ -1,11 +1,8 @@
-import os
 import random
 from itertools import product
-
-import pandas as pd
 from pathlib import Path
 
-from utils import rows_to_dataset, validate_dataset
+from utils import rows_to_dataset, validate_dataset, export_dataset, hash_inputs, needs_build, load_source, source_version
 
 
 questions = [
@@ -49,12 +46,37 @@ def _determine_inversed_order(df):
     df.loc[df.id.isin(indices[:len(indices) // 2]), "inversed_order"] = True
 
 
-if __name__ == "__main__":
-    root_path = Path("zrc/datasets/prosaudit/english/dev").absolute()
-    gold_path = root_path / "gold.csv"
-    gold_df = pd.read_csv(gold_path)
+SOURCE = {"csv": "zrc/datasets/prosaudit/english/dev/gold.csv"}
+
+
+TASK_TYPES = ("protosyntax", "lexical")
+
+
+def _repo_id(task_type):
+    return f"DynamicSuperb/ProsodyNaturalness_ProsAudit-{task_type.capitalize()}"
+
+
+def inputs_hashes():
+    source = source_version(SOURCE)
+    return {_repo_id(task_type): hash_inputs(source, Path(__file__), task_type) for task_type in TASK_TYPES}
+
+
+def build(gold_df=None):
+    root_path = Path(SOURCE["csv"]).parent.absolute()
+    hashes = inputs_hashes()
+    if not any(needs_build(repo_id, inputs_hash) for repo_id, inputs_hash in hashes.items()):
+        print("ProsodyNaturalness tasks are up to date")
+        return
+    if gold_df is None:
+        gold_df = load_source(SOURCE)
+
+    for task_type in TASK_TYPES:
+        repo_id = _repo_id(task_type)
+        inputs_hash = hashes[repo_id]
+        if not needs_build(repo_id, inputs_hash):
+            print(f"{repo_id} is up to date")
+            continue
 
-    for task_type in ("protosyntax", "lexical"):
         df = gold_df[gold_df.type == task_type].copy()
         _determine_inversed_order(df)
 
@@ -79,4 +101,8 @@ if __name__ == "__main__":
 
         ds = rows_to_dataset(rows)
         validate_dataset(ds)
-        ds.push_to_hub(repo_id=f"DynamicSuperb/ProsodyNaturalness_ProsAudit-{task_type.capitalize()}", split="test", token=os.environ["HF_TOKEN"])
+        export_dataset(ds, repo_id=repo_id, split="test", inputs_hash=inputs_hash)
+
+
+if __name__ == "__main__":
+    build()
@@ -0,0 +1,76 @@
+import argparse
+import importlib
+import json
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from utils import load_source, needs_build
+
+
+def find_task_modules(task_names=None):
+    """
+    Every module next to this file that defines SOURCE, inputs_hashes() and build(source) is a task builder
+    """
+    modules = []
+    for path in sorted(Path(__file__).parent.glob("*.py")):
+        if path.stem in ("run_tasks", "utils") or (task_names and path.stem not in task_names):
+            continue
+        module = importlib.import_module(path.stem)
+        if hasattr(module, "SOURCE") and hasattr(module, "inputs_hashes") and hasattr(module, "build"):
+            modules.append(module)
+    unknown = set(task_names or ()) - {module.__name__ for module in modules}
+    if unknown:
+        raise SystemExit(f"unknown tasks: {', '.join(sorted(unknown))}")
+    return modules
+
+
+def run_tasks(task_names=None, num_workers=4):
+    # group builders by source so that each source is loaded only once
+        # the manifest is checked first, sources whose tasks are all up to date are never loaded
+    builders_by_source = defaultdict(list)
+    failed = []
+    for module in find_task_modules(task_names):
+        try:
+            stale = any(needs_build(repo_id, inputs_hash) for repo_id, inputs_hash in module.inputs_hashes().items())
+        except Exception as e:
+            print(f"{module.__name__} failed: {e!r}")
+            failed.append(module.__name__)
+            continue
+        if not stale:
+            print(f"{module.__name__} is up to date")
+            continue
+        builders_by_source[json.dumps(module.SOURCE, sort_keys=True)].append(module)
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = {}
+        for source_key, modules in builders_by_source.items():
+            try:
+                source = load_source(json.loads(source_key))
+            except Exception as e:
+                print(f"could not load {source_key}: {e!r}")
+                failed.extend(module.__name__ for module in modules)
+                continue
+            for module in modules:
+                # hub datasets are memory-mapped, so only a reference to the cache files is sent to the workers
+                futures[executor.submit(module.build, source)] = module.__name__
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+                print(f"{futures[future]} done")
+            except Exception as e:
+                print(f"{futures[future]} failed: {e!r}")
+                failed.append(futures[future])
+
+    if failed:
+        raise SystemExit(f"failed tasks: {', '.join(sorted(failed))}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build every LinguisticSUPERB task")
+    parser.add_argument("tasks", nargs="*", help="task modules to build, e.g. phone_segment_counting (default: all)")
+    parser.add_argument("--num_workers", type=int, default=4)
+    args = parser.parse_args()
+
+    run_tasks(args.tasks, num_workers=args.num_workers)
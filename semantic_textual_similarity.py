@@ -1,9 +1,10 @@
-import os
+from pathlib import Path
+
 import numpy as np
 
-from datasets import load_dataset, Audio
+from datasets import Audio
 
-from utils import validate_dataset, rows_to_dataset
+from utils import cast_audio, validate_dataset, rows_to_dataset, export_dataset, hash_inputs, needs_build, load_source, source_version
 
 
 questions = [ # first pair is more similar
@@ -44,15 +45,30 @@ inversed_questions = [ # second pair is more similar
 ]
 
 
-if __name__ == "__main__":
-    ds = load_dataset("juice500/spoken_sts", cache_dir="datasets_cache")
+SOURCE = {"path": "juice500/spoken_sts", "split": "test", "cache_dir": "datasets_cache"}
+REPO_ID = "DynamicSuperb/SemanticTextualSimilarity_SpokenSTS"
+
+
+def inputs_hashes():
+    return {REPO_ID: hash_inputs(source_version(SOURCE), Path(__file__))}
+
 
-    similarities = np.array(ds["test"]["similarity"])
-    speakers = np.array(ds["test"]["speaker_id"])
+def build(ds=None):
+    repo_id = REPO_ID
+    inputs_hash = inputs_hashes()[repo_id]
+    if not needs_build(repo_id, inputs_hash):
+        print(f"{repo_id} is up to date")
+        return
+
+    if ds is None:
+        ds = load_source(SOURCE)
+
+    similarities = np.array(ds["similarity"])
+    speakers = np.array(ds["speaker_id"])
     indices = np.arange(len(similarities))
     unique_ids = [
         f"{st}_{pid}"
-        for (st, pid) in zip(ds["test"]["subtask"], ds["test"]["pair_id"])  # ["task"] removed for filename-level uniqueness
+        for (st, pid) in zip(ds["subtask"], ds["pair_id"])  # ["task"] removed for filename-level uniqueness
     ]
 
     total_quadruplets = 250
@@ -81,20 +97,26 @@ if __name__ == "__main__":
     for i, (l_index, r_index, is_flipped) in enumerate(zip(l_pair, r_pair, is_flipped_list)):
         rows["instruction"].append(inversed_questions[i % len(inversed_questions)] if is_flipped else questions[i % len(questions)])
         rows["label"].append("yes" if (
-            ((ds["test"]["similarity"][l_index] > ds["test"]["similarity"][r_index]) and (not is_flipped))
-            or ((ds["test"]["similarity"][l_index] < ds["test"]["similarity"][r_index]) and (is_flipped))
+            ((ds["similarity"][l_index] > ds["similarity"][r_index]) and (not is_flipped))
+            or ((ds["similarity"][l_index] < ds["similarity"][r_index]) and (is_flipped))
         ) else "no")
-        rows["file"].append(f"{ds['test']['subtask'][l_index]}_{ds['test']['pair_id'][l_index]}_0_human-speaker-{ds['test']['speaker_id'][l_index]}.wav")
-        rows["file2"].append(f"{ds['test']['subtask'][l_index]}_{ds['test']['pair_id'][l_index]}_1_human-speaker-{ds['test']['speaker_id'][l_index]}.wav")
-        rows["file3"].append(f"{ds['test']['subtask'][r_index]}_{ds['test']['pair_id'][r_index]}_0_human-speaker-{ds['test']['speaker_id'][r_index]}.wav")
-        rows["file4"].append(f"{ds['test']['subtask'][r_index]}_{ds['test']['pair_id'][r_index]}_1_human-speaker-{ds['test']['speaker_id'][r_index]}.wav")
+        rows["file"].append(f"{ds['subtask'][l_index]}_{ds['pair_id'][l_index]}_0_human-speaker-{ds['speaker_id'][l_index]}.wav")
+        rows["file2"].append(f"{ds['subtask'][l_index]}_{ds['pair_id'][l_index]}_1_human-speaker-{ds['speaker_id'][l_index]}.wav")
+        rows["file3"].append(f"{ds['subtask'][r_index]}_{ds['pair_id'][r_index]}_0_human-speaker-{ds['speaker_id'][r_index]}.wav")
+        rows["file4"].append(f"{ds['subtask'][r_index]}_{ds['pair_id'][r_index]}_1_human-speaker-{ds['speaker_id'][r_index]}.wav")
 
     new_ds = rows_to_dataset(rows)
-    new_ds = new_ds.add_column("audio", ds["test"].select(l_pair)["audio_a"]).cast_column("audio", Audio(sampling_rate=16000))
-    new_ds = new_ds.add_column("audio2", ds["test"].select(l_pair)["audio_b"]).cast_column("audio2", Audio(sampling_rate=16000))
-    new_ds = new_ds.add_column("audio3", ds["test"].select(r_pair)["audio_a"]).cast_column("audio3", Audio(sampling_rate=16000))
-    new_ds = new_ds.add_column("audio4", ds["test"].select(r_pair)["audio_b"]).cast_column("audio4", Audio(sampling_rate=16000))
+    # keep the source audio undecoded; cast_audio resamples each clip once through the shared cache
+    test_ds = ds.cast_column("audio_a", Audio(decode=False)).cast_column("audio_b", Audio(decode=False))
+    new_ds = cast_audio(new_ds.add_column("audio", test_ds.select(l_pair)["audio_a"]), "audio")
+    new_ds = cast_audio(new_ds.add_column("audio2", test_ds.select(l_pair)["audio_b"]), "audio2")
+    new_ds = cast_audio(new_ds.add_column("audio3", test_ds.select(r_pair)["audio_a"]), "audio3")
+    new_ds = cast_audio(new_ds.add_column("audio4", test_ds.select(r_pair)["audio_b"]), "audio4")
 
     # Validate & Push
     validate_dataset(new_ds)
-    new_ds.push_to_hub(repo_id="DynamicSuperb/SemanticTextualSimilarity_SpokenSTS", split="test", token=os.environ["HF_TOKEN"])
+    export_dataset(new_ds, repo_id=repo_id, split="test", inputs_hash=inputs_hash)
+
+
+if __name__ == "__main__":
+    build()
@@ -1,11 +1,8 @@
-import os
 import random
 from itertools import product
-
-import pandas as pd
 from pathlib import Path
 
-from utils import rows_to_dataset, validate_dataset
+from utils import rows_to_dataset, validate_dataset, export_dataset, hash_inputs, needs_build, load_source, source_version
 
 
 questions = [
@@ -71,10 +68,24 @@ def _determine_inversed_order(df):
     df.loc[indices, "inversed_order"] = True
 
 
-if __name__ == "__main__":
-    root_path = Path("zrc/datasets/sLM21/syntactic/dev").absolute()
-    gold_path = root_path / "gold.csv"
-    df = pd.read_csv(gold_path)
+SOURCE = {"csv": "zrc/datasets/sLM21/syntactic/dev/gold.csv"}
+REPO_ID = "DynamicSuperb/SentenceGrammarAcceptability_sBLIMP"
+
+
+def inputs_hashes():
+    return {REPO_ID: hash_inputs(source_version(SOURCE), Path(__file__))}
+
+
+def build(df=None):
+    root_path = Path(SOURCE["csv"]).parent.absolute()
+    repo_id = REPO_ID
+    inputs_hash = inputs_hashes()[repo_id]
+    if not needs_build(repo_id, inputs_hash):
+        print(f"{repo_id} is up to date")
+        return
+
+    if df is None:
+        df = load_source(SOURCE)
 
     assert df.subtype.nunique() == 63
     assert df.voice.nunique() == 4
@@ -104,4 +115,8 @@ if __name__ == "__main__":
 
     ds = rows_to_dataset(rows)
     validate_dataset(ds)
-    ds.push_to_hub(repo_id="DynamicSuperb/SentenceGrammarAcceptability_sBLIMP", split="test", token=os.environ["HF_TOKEN"])
+    export_dataset(ds, repo_id=repo_id, split="test", inputs_hash=inputs_hash)
+
+
+if __name__ == "__main__":
+    build()
@@ -1,60 +1,509 @@
+import hashlib
+import inspect
+import io
+import json
+import math
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import Dict
+from typing import Dict, List, Optional
 
-from datasets import Audio, Dataset
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import soundfile as sf
+from datasets import Audio, Dataset, DatasetInfo, SplitDict, SplitInfo, load_dataset
+from datasets.data_files import sanitize_patterns
+from datasets.info import DatasetInfosDict
+from datasets.table import embed_table_storage
+from datasets.utils.metadata import MetadataConfigs
+from datasets.utils.py_utils import convert_file_size_to_int
+from huggingface_hub import DatasetCard, DatasetCardData, HfApi
+from huggingface_hub.hf_api import RepoFile
 from tqdm import tqdm
 
 
-def rows_to_dataset(rows: Dict[str, list]) -> Dataset:
-    for key in ("audio", "audio2", "audio3", "audio4"):
-        if key in rows:
-            file_key = "file" if key == "audio" else f"file{key[-1]}"
-            rows[file_key] = [Path(f).name for f in rows[key]]
-            assert all([Path(f).exists() for f in rows[key]])
+AUDIO_KEYS = ("audio", "audio2", "audio3", "audio4")
+
+# resampled audio shared by every task and run, keyed by source content hash and target rate
+RESAMPLE_CACHE_DIR = Path(os.environ.get("RESAMPLE_CACHE_DIR", "datasets_cache/resampled"))
+RESAMPLE_CACHE_MAX_BYTES = int(os.environ.get("RESAMPLE_CACHE_MAX_BYTES", 20 * 1024 ** 3))
+
+# if set, export_dataset writes hub-compatible parquet shards here instead of pushing to the hub
+EXPORT_DIR = os.environ.get("EXPORT_DIR")
+
+# one json per task repo_id recording the hashes of its inputs and outputs at the last successful build
+BUILD_MANIFEST_DIR = Path(os.environ.get("BUILD_MANIFEST_DIR", "build_manifest"))
+FORCE_REBUILD = os.environ.get("FORCE_REBUILD", "") not in ("", "0")
+
+
+def _read_audio_bytes(audio: dict) -> bytes:
+    if audio["bytes"] is not None:
+        return audio["bytes"]
+    with open(audio["path"], "rb") as f:
+        return f.read()
+
+
+def _resample_cached(audio: dict, sampling_rate: int, cache_dir: Path) -> dict:
+    content = _read_audio_bytes(audio)
+    info = sf.info(io.BytesIO(content))
+    if info.samplerate == sampling_rate and info.channels == 1:
+        # already in its final form
+        return audio
+
+    # keep the original file name so that embedded paths stay meaningful
+    name = Path(audio["path"]).stem if audio["path"] else "audio"
+    key = f"{hashlib.sha256(content).hexdigest()}_{sampling_rate}"
+    cached_path = cache_dir / key / f"{name}.wav"
+    if cached_path.exists():
+        # refresh the LRU timestamp
+        os.utime(cached_path)
+    else:
+        # decode exactly like datasets does, then store as 16-bit PCM
+            # decoded arrays differ from an uncached cast by the quantization step, at most ~3e-5
+        decoded = Audio(sampling_rate=sampling_rate).decode_example({"path": audio["path"], "bytes": content})
+        cached_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cached_path.with_suffix(f".{os.getpid()}.tmp")
+        sf.write(tmp_path, decoded["array"], samplerate=sampling_rate, subtype="PCM_16", format="WAV")
+        os.replace(tmp_path, cached_path)
+    return {"path": str(cached_path.absolute()), "bytes": None}
+
+
+def evict_resample_cache(cache_dir: Path = RESAMPLE_CACHE_DIR, max_bytes: int = RESAMPLE_CACHE_MAX_BYTES) -> None:
+    """
+    Remove the least recently used entries until the cache fits in max_bytes
+    """
+    # another process may evict the same files concurrently, vanished files are skipped
+    entries = []
+    for f in cache_dir.glob("*/*.wav"):
+        try:
+            stat = f.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, f))
+    total_bytes = sum(size for _, size, _ in entries)
+    for _, size, f in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        f.unlink(missing_ok=True)
+        try:
+            f.parent.rmdir()
+        except OSError:
+            pass
+        total_bytes -= size
+
+
+def cast_audio(ds: Dataset, key: str = "audio", sampling_rate: int = 16_000, cache_dir: Path = RESAMPLE_CACHE_DIR, num_proc: Optional[int] = None) -> Dataset:
+    """
+    Same as ds.cast_column(key, Audio(sampling_rate)), but every clip is resampled at most once
+    and stored in the on-disk cache, so later decodes read ready-made audio
+    """
+    ds = ds.cast_column(key, Audio(decode=False))
+    ds = ds.map(
+        lambda batch: {key: [_resample_cached(audio, sampling_rate, Path(cache_dir)) for audio in batch[key]]},
+        batched=True,
+        num_proc=num_proc,
+        # the cached map output points into the resample cache, whose files may have been evicted since
+        load_from_cache_file=False,
+        desc=f"Resampling {key}",
+    )
+    evict_resample_cache(Path(cache_dir))
+    return ds.cast_column(key, Audio(sampling_rate=sampling_rate))
+
+
+def _probe_audio_file(path: str):
+    if not Path(path).exists():
+        return None
+    return sf.info(path)
+
+
+def probe_audio_files(paths: List[str], max_workers: int = 32) -> Dict[str, sf._SoundFileInfo]:
+    """
+    Check that every path exists and read its header (sample rate, channels, frames) concurrently
+    Raises a single FileNotFoundError listing every missing path
+    """
+    paths = sorted(set(paths))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        infos = dict(zip(paths, executor.map(_probe_audio_file, paths)))
+
+    missing = [path for path, info in infos.items() if info is None]
+    if missing:
+        raise FileNotFoundError(f"{len(missing)} audio files are missing:\n" + "\n".join(missing))
+    return infos
+
+
+def rows_to_dataset(rows: Dict[str, list], with_metadata: bool = False, max_workers: int = 32) -> Dataset:
+    """
+    If with_metadata is set, the probed sampling_rate, channels and num_frames are attached as columns
+    (with the same suffixes as file); drop them before validate_dataset
+    """
+    audio_keys = [key for key in AUDIO_KEYS if key in rows]
+    infos = probe_audio_files([f for key in audio_keys for f in rows[key]], max_workers=max_workers)
+
+    for key in audio_keys:
+        suffix = "" if key == "audio" else key[-1]
+        rows[f"file{suffix}"] = [Path(f).name for f in rows[key]]
+        if with_metadata:
+            rows[f"sampling_rate{suffix}"] = [infos[f].samplerate for f in rows[key]]
+            rows[f"channels{suffix}"] = [infos[f].channels for f in rows[key]]
+            rows[f"num_frames{suffix}"] = [infos[f].frames for f in rows[key]]
 
     ds = Dataset.from_dict(rows)
     for key in rows.keys():
         if "audio" in key:
-            ds = ds.cast_column(key, Audio(sampling_rate=16000))
+            ds = cast_audio(ds, key)
 
     return ds
 
 
-def validate_dataset(ds: Dataset) -> None:
+def take_rows(ds: Dataset, indices, columns: Optional[List[str]] = None) -> pa.Table:
+    """
+    Rows of ds as a pyarrow Table, gathered with a single Arrow take (audio stays undecoded)
+    Indices are positions in ds, any select/filter indices mapping is resolved first
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    if ds._indices is not None:
+        indices = ds._indices.column(0).to_numpy()[indices]
+    table = ds.data.table
+    if columns is not None:
+        table = table.select(columns)
+    return table.take(indices)
+
+
+@lru_cache(maxsize=None)
+def panphon_feature_table():
+    """
+    panphon's FeatureTable, built on first use and shared by every task in the process
+    """
+    from panphon import FeatureTable
+    return FeatureTable()
+
+
+@lru_cache(maxsize=None)
+def panphon_distance():
+    from panphon.distance import Distance
+    return Distance()
+
+
+@lru_cache(maxsize=None)
+def panphon_sonority():
+    from panphon.sonority import Sonority
+    return Sonority()
+
+
+def _header_duration(audio: dict) -> float:
+    # soundfile only parses the container header (WAV/FLAC frame count) here
+    try:
+        if audio["bytes"] is not None:
+            info = sf.info(io.BytesIO(audio["bytes"]))
+        else:
+            info = sf.info(audio["path"])
+        return info.frames / info.samplerate
+    except (RuntimeError, sf.LibsndfileError):
+        # unsupported container, fall back to decoding
+        decoded = Audio(decode=True).decode_example(audio)
+        return len(decoded["array"]) / decoded["sampling_rate"]
+
+
+def audio_durations(ds: Dataset, key: str = "audio", batch_size: int = 1000, cache_dir: Optional[str] = None) -> np.ndarray:
+    """
+    Duration (in seconds) of every clip in an audio column, read from the file headers without decoding
+    If cache_dir is given, the index is stored there as a sidecar .npy file keyed by the dataset fingerprint
+    """
+    if cache_dir is not None:
+        index_path = Path(cache_dir) / f"durations_{ds._fingerprint}_{key}.npy"
+        if index_path.exists():
+            return np.load(index_path)
+
+    durations = []
+    table = ds.select_columns([key]).with_format("arrow")
+    for batch in tqdm(table.iter(batch_size=batch_size), total=math.ceil(len(ds) / batch_size)):
+        durations.extend([_header_duration(audio) for audio in batch[key].to_pylist()])
+    durations = np.array(durations, dtype=np.float64)
+
+    if cache_dir is not None:
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        np.save(index_path, durations)
+    return durations
+
+
+def stratified_sample(ds: Dataset, column: str, fraction: float, batch_size: int = 10_000) -> List[int]:
+    """
+    Select int(fraction * stratum size) row indices per value of column, reading only that column
+    Strata are visited in sorted order and the i-th one is sampled with random.seed(i),
+    exactly like the original per-row loops, so the selections do not change
+    """
+    table = ds.select_columns([column]).with_format("arrow")
+    values = np.concatenate([
+        batch[column].to_numpy(zero_copy_only=False)
+        for batch in table.iter(batch_size=batch_size)
+    ])
+    # a stable sort keeps the indices of each stratum in ascending order
+    order = np.argsort(values, kind="stable")
+    _, starts = np.unique(values[order], return_index=True)
+
+    selected_indices = []
+    for i, indices in enumerate(np.split(order, starts[1:])):
+        random.seed(i)
+        selected_indices.extend(random.sample(indices.tolist(), int(len(indices) * fraction)))
+    return selected_indices
+
+
+def validate_dataset(ds: Dataset, batch_size: int = 256, durations: Optional[Dict[str, np.ndarray]] = None) -> None:
+    """
+    durations optionally gives the clip durations (in seconds) of an audio column, row by row,
+    e.g. when ds is a selection of an already validated dataset; other audio columns are read from the file headers
+    """
     print("Validating dataset...")
 
     # column name check
     assert len(set(ds.features.keys()) - {"instruction", "label", "audio", "audio2", "audio3", "audio4", "file", "file2", "file3", "file4"}) == 0
 
+    audio_keys = [key for key in AUDIO_KEYS if key in ds.features]
+    for key in audio_keys:
+        assert ds.features[key].sampling_rate == 16_000
+    num_audios = (len(ds.features) // 2) - 1
+    file_keys = [f"file{'' if i == 0 else i+1}" for i in range(num_audios)]
+
+    # label, instruction and file checks run as Arrow compute kernels on the non-audio columns
+    table = ds.select_columns(["label", "instruction"] + file_keys).with_format("arrow")[:]
+
     # label check
-    sample_size = len(ds["label"])
+    labels = table["label"]
+    sample_size = len(labels)
     assert sample_size >= 32
-    assert all([(v != None) and (v != "") for v in ds["label"]])
+    assert labels.null_count == 0
+    if pa.types.is_string(labels.type) or pa.types.is_large_string(labels.type):
+        assert not pc.any(pc.equal(labels, "")).as_py()
 
     # instruction check
-    instruction_size = len(set(ds["instruction"]))
+    instructions = table["instruction"]
+    instruction_size = pc.count_distinct(instructions).as_py()
     assert instruction_size >= max(sample_size / 20, 10)
-    assert all([isinstance(v, str) for v in ds["instruction"]])
-    assert all([len(v) > 0 for v in ds["instruction"]])
+    assert pa.types.is_string(instructions.type) or pa.types.is_large_string(instructions.type)
+    assert instructions.null_count == 0
+    assert pc.min(pc.utf8_length(instructions)).as_py() > 0
 
     # file uniqueness check
-    num_audios = (len(ds.features) // 2) - 1
     if num_audios > 1:
-        assert sample_size == len(set(zip(*[ds[f"file{'' if i == 0 else i+1}"] for i in range(num_audios)])))
+        assert sample_size == table.group_by(file_keys).aggregate([]).num_rows
     # the first file will be used as an index by DynamicSUPERB and thus needs to be unique
-    assert sample_size == len(set(ds["file"]))
+    assert sample_size == pc.count_distinct(table["file"], mode="all").as_py()
 
     # audio length check
-    total_audio_length = 0
-    for key in ("audio", "audio2", "audio3", "audio4"):
-        if key in ds.features:
-            assert ds.features[key].sampling_rate == 16_000
-            for audio in tqdm(ds[key]):
-                assert len(audio["array"]) > 0
-                total_audio_length += len(audio["array"])
-    assert total_audio_length / 16_000 < 3600
+    #   a single pass over fixed-size Arrow batches; audio is never decoded, clip lengths come from the file headers
+    durations = dict(durations or {})
+    header_keys = [key for key in audio_keys if key not in durations]
+    if header_keys:
+        header_durations = {key: [] for key in header_keys}
+        audio_table = ds.select_columns(header_keys).with_format("arrow")
+        for batch in tqdm(audio_table.iter(batch_size=batch_size), total=math.ceil(len(ds) / batch_size)):
+            for key in header_keys:
+                header_durations[key].extend(_header_duration(audio) for audio in batch[key].to_pylist())
+        durations.update({key: np.array(header_durations[key], dtype=np.float64) for key in header_keys})
+    total_audio_length = 0.0
+    for key in audio_keys:
+        assert len(durations[key]) == sample_size
+        assert (durations[key] > 0).all()
+        total_audio_length += float(durations[key].sum())
+    assert total_audio_length < 3600
 
     print("Dataset validated!")
     print(f"Sample size: {sample_size}")
     print(f"Unique instructions: {instruction_size}")
-    print(f"Audio length: {total_audio_length / 16_000 / 60:.1f} minutes")
+    print(f"Audio length: {total_audio_length / 60:.1f} minutes")
+
+
+def export_to_dir(ds: Dataset, repo_id: str, export_dir: str, split: str = "test", max_shard_size: str = "500MB", max_workers: int = 4) -> Path:
+    """
+    Write the dataset as hub-compatible parquet shards to export_dir/repo_id/data,
+    with the same layout and embedded audio as push_to_hub
+    Shards are written by a pool of max_workers threads and renamed into place once complete,
+    so a rerun skips every shard that is already there
+    The split info for the dataset card is written last, it marks the export as complete
+    """
+    repo_dir = Path(export_dir) / repo_id
+    data_dir = repo_dir / "data"
+    data_dir.mkdir(parents=True, exist_ok=True)
+    num_shards = max(int(ds._estimate_nbytes() / convert_file_size_to_int(max_shard_size)) + 1, 1)
+
+    # shards of a previous attempt can only be reused if they come from the same dataset
+    state_path, info_path = repo_dir / f".{split}_export.json", repo_dir / f".{split}_info.json"
+    state = {"fingerprint": ds._fingerprint, "num_shards": num_shards}
+    if not state_path.exists() or json.loads(state_path.read_text()) != state:
+        info_path.unlink(missing_ok=True)
+        for shard_path in data_dir.glob(f"{split}-*.parquet"):
+            shard_path.unlink()
+        state_path.write_text(json.dumps(state))
+
+    def _write_shard(index: int) -> Path:
+        shard_path = data_dir / f"{split}-{index:05d}-of-{num_shards:05d}.parquet"
+        if shard_path.exists():
+            return shard_path
+        shard = ds.shard(num_shards=num_shards, index=index, contiguous=True).with_format("arrow")
+        shard = shard.map(embed_table_storage, batched=True, batch_size=1000, keep_in_memory=True)
+        tmp_path = shard_path.with_suffix(f".{os.getpid()}.tmp")
+        shard.to_parquet(tmp_path)
+        os.replace(tmp_path, shard_path)
+        return shard_path
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        shard_paths = list(tqdm(executor.map(_write_shard, range(num_shards)), total=num_shards, desc=f"Exporting {repo_id}"))
+
+    # the same sizes push_to_hub puts in the dataset card
+    info = ds.info.copy()
+    info.download_checksums = None
+    info.download_size = sum(shard_path.stat().st_size for shard_path in shard_paths)
+    info.dataset_size = ds._estimate_nbytes()
+    info.size_in_bytes = info.download_size + info.dataset_size
+    info.splits = SplitDict({split: SplitInfo(split, num_bytes=info.dataset_size, num_examples=len(ds))})
+    info_path.write_text(json.dumps(info._to_yaml_dict()))
+    return repo_dir
+
+
+def hash_inputs(*inputs) -> str:
+    """
+    Hash the inputs of a task build: Paths are hashed by file content, callables by source code,
+    everything else (instruction lists, seeds, revisions, ...) by its json form
+    """
+    h = hashlib.sha256()
+    for value in inputs:
+        if isinstance(value, Path):
+            with open(value, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+        elif callable(value):
+            h.update(inspect.getsource(value).encode())
+        else:
+            h.update(json.dumps(value, sort_keys=True, default=str).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def source_revision(repo_id: str, revision: Optional[str] = None) -> str:
+    """
+    Resolve a hub dataset revision to its commit sha, so that upstream changes trigger a rebuild
+    """
+    try:
+        return HfApi().dataset_info(repo_id, revision=revision).sha
+    except Exception:
+        # offline, fall back to the revision name
+        return f"{repo_id}@{revision}"
+
+
+def load_source(source: dict):
+    """
+    Load a task source: {"csv": path} is read with pandas, anything else is passed to load_dataset
+    """
+    if "csv" in source:
+        return pd.read_csv(source["csv"])
+    return load_dataset(**source)
+
+
+def source_version(source: dict) -> str:
+    """
+    What a build depends on for a task source: the gold.csv content or the resolved hub revision
+    """
+    if "csv" in source:
+        return hash_inputs(Path(source["csv"]))
+    return source_revision(source["path"], source.get("revision"))
+
+
+def _manifest_path(repo_id: str) -> Path:
+    return BUILD_MANIFEST_DIR / f"{repo_id}.json"
+
+
+def _export_target() -> str:
+    return f"dir:{Path(EXPORT_DIR).absolute()}" if EXPORT_DIR else "hub"
+
+
+def needs_build(repo_id: str, inputs_hash: str) -> bool:
+    if FORCE_REBUILD or not _manifest_path(repo_id).exists():
+        return True
+    entry = json.loads(_manifest_path(repo_id).read_text())
+    return entry["inputs"] != inputs_hash or entry["target"] != _export_target()
+
+
+def record_build(repo_id: str, inputs_hash: str, ds: Dataset) -> None:
+    manifest_path = _manifest_path(repo_id)
+    manifest_path.parent.mkdir(parents=True, exist_ok=True)
+    entry = {"inputs": inputs_hash, "outputs": ds._fingerprint, "target": _export_target(), "num_rows": len(ds)}
+    manifest_path.write_text(json.dumps(entry, indent=2))
+
+
+def export_dataset(ds: Dataset, repo_id: str, split: str = "test", inputs_hash: Optional[str] = None) -> None:
+    """
+    Final stage of every task: write local shards if EXPORT_DIR is set, otherwise push to the hub
+    If inputs_hash is given, the build is recorded in the manifest once the export succeeded
+    """
+    if EXPORT_DIR:
+        export_to_dir(ds, repo_id, EXPORT_DIR, split=split)
+    else:
+        ds.push_to_hub(repo_id=repo_id, split=split, token=os.environ["HF_TOKEN"])
+
+    if inputs_hash is not None:
+        record_build(repo_id, inputs_hash, ds)
+
+
+def _dataset_card(api: HfApi, repo_id: str, infos: Dict[str, DatasetInfo]) -> str:
+    # update the card on the hub with the exported splits, the way push_to_hub does
+        # splits that were not exported keep their info, shards and data_files pattern
+    repo_files = [f for f in api.list_repo_tree(repo_id, repo_type="dataset", recursive=True) if isinstance(f, RepoFile)]
+    if any(f.path == "README.md" for f in repo_files):
+        card = DatasetCard.load(api.hf_hub_download(repo_id, "README.md", repo_type="dataset"))
+    else:
+        card = DatasetCard(f"---\n{DatasetCardData()}\n---\n")
+    repo_info = DatasetInfosDict.from_dataset_card_data(card.data).get("default")
+    metadata_config = MetadataConfigs.from_dataset_card_data(card.data).get("default", {})
+
+    info = next(iter(infos.values())).copy()
+    splits = {name: split_info for name, split_info in (repo_info.splits or {}).items() if name not in infos} if repo_info else {}
+    for other in [*infos.values(), *([repo_info] if splits else [])]:
+        if other.features != info.features:
+            raise ValueError(f"Features of the splits of {repo_id} don't match: {info.features} != {other.features}")
+    splits.update({name: split_info.splits[name] for name, split_info in infos.items()})
+    info.splits = SplitDict(splits)
+    info.dataset_size = sum(split_info.num_bytes or 0 for split_info in splits.values())
+    info.download_size = sum(split_info.download_size for split_info in infos.values()) + sum(
+        f.size for f in repo_files
+        if f.path.startswith("data/") and not any(f.path.startswith(f"data/{split}-") for split in infos)
+    )
+    info.size_in_bytes = info.download_size + info.dataset_size
+
+    data_files = sanitize_patterns(metadata_config.get("data_files", {}))
+    data_files.update({split: [f"data/{split}-*"] for split in infos})
+    DatasetInfosDict({"default": info}).to_dataset_card_data(card.data)
+    MetadataConfigs({"default": {"data_files": [
+        {"split": split, "path": patterns[0] if len(patterns) == 1 else patterns} for split, patterns in data_files.items()
+    ]}}).to_dataset_card_data(card.data)
+    return str(card)
+
+
+def sync_exports(export_dir: str, token: Optional[str] = None) -> None:
+    """
+    Publish every dataset exported by export_to_dir (export_dir/org/name) to the hub
+    Like push_to_hub, the shards of a previous push of the same split are deleted and the dataset card is updated
+    """
+    api = HfApi(token=token or os.environ["HF_TOKEN"])
+    for repo_dir in sorted(Path(export_dir).glob("*/*")):
+        repo_id = f"{repo_dir.parent.name}/{repo_dir.name}"
+        # only splits whose export completed have their info written
+        infos = {
+            info_path.name[1:-len("_info.json")]: DatasetInfo._from_yaml_dict(json.loads(info_path.read_text()))
+            for info_path in sorted(repo_dir.glob(".*_info.json"))
+        }
+        if not infos:
+            print(f"{repo_id} has no complete export, skipped")
+            continue
+        api.create_repo(repo_id, repo_type="dataset", exist_ok=True)
+        (repo_dir / "README.md").write_text(_dataset_card(api, repo_id, infos))
+        api.upload_folder(
+            repo_id=repo_id,
+            repo_type="dataset",
+            folder_path=repo_dir,
+            allow_patterns=["README.md", *(f"data/{split}-*.parquet" for split in infos)],
+            delete_patterns=[f"data/{split}-*" for split in infos],
+        )